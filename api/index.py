@@ -1,67 +1,3434 @@
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, g, has_app_context, request, jsonify, send_file
 import os
+import sys
 import hashlib
 import uuid
 import base64
-import subprocess
 import json
-from datetime import datetime
+import threading
+import selectors
+import codecs
+import marshal
+import importlib.util
+import traceback
+import logging
+import hmac
+import io
+import zipfile
+import shutil
+import tempfile
+from contextlib import asynccontextmanager, contextmanager
+from urllib.parse import parse_qs
+import time
+import math
+import struct
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
 from pathlib import Path
 import html
+# subprocess, sqlite3, gzip, tarfile, python-multipart and the profiler are
+# imported where they are used, so a cold start only pays for what it serves
 
 # Initialize Flask app
 app = Flask(__name__)
 
 # Configuration
-UPLOAD_FOLDER = '/tmp/uploads'  # Use /tmp for Vercel serverless
-PASSWORD_FILE = '/tmp/passwords.json'
-DATA_FILE = '/tmp/files.json'
+DATA_DIR = os.environ.get('PASTEBIN_DATA_DIR', '/tmp')  # Use /tmp for Vercel serverless
+UPLOAD_FOLDER = os.path.join(DATA_DIR, 'uploads')
+BLOB_FOLDER = os.path.join(UPLOAD_FOLDER, 'blobs')  # Content-addressed: blobs/<sha[:2]>/<sha>
+BLOB_TMP_FOLDER = os.path.join(BLOB_FOLDER, 'tmp')
+DB_FILE = os.path.join(DATA_DIR, 'pastebin.db')
+GENERATION_FILE = os.path.join(DATA_DIR, 'pastebin.gen')  # Touched after every metadata write
+UPLOAD_CHUNK_SIZE = 64 * 1024  # Streaming uploads hold at most one chunk in memory
+UPLOAD_MAX_FIELD_SIZE = 64 * 1024  # Non-file multipart fields (filename, password, ...)
+BATCH_MAX_FILES = int(os.environ.get('BATCH_MAX_FILES', '1000'))  # Per batch upload or download
+PASTE_DEFAULT_TTL = int(os.environ.get('PASTE_DEFAULT_TTL', '0'))  # Seconds; 0 keeps pastes until evicted
+PASTE_MAX_TTL = int(os.environ.get('PASTE_MAX_TTL', '0'))  # Largest ttl accepted on upload; 0 for no limit
+STORAGE_QUOTA_BYTES = int(os.environ.get('STORAGE_QUOTA_BYTES', '0'))  # Blob bytes before LRU eviction; 0 disables
+SWEEP_INTERVAL = int(os.environ.get('SWEEP_INTERVAL', '30'))  # Seconds between background sweeps
+SWEEP_BATCH = 100  # Pastes removed per sweeper transaction
+METADATA_CACHE_MAX_ENTRIES = int(os.environ.get('METADATA_CACHE_MAX_ENTRIES', '50000'))
+RAW_CACHE_MAX_AGE = int(os.environ.get('RAW_CACHE_MAX_AGE', '86400'))  # Cache-Control for public pastes
+BLOB_COMPRESSION = os.environ.get('BLOB_COMPRESSION', 'gzip')  # 'gzip' or 'none' for new blobs
+BLOB_COMPRESSION_LEVEL = int(os.environ.get('BLOB_COMPRESSION_LEVEL', '6'))
+BLOB_COMPRESSION_MIN_SIZE = 512  # Smaller blobs gain little over the gzip header
+PRECOMPILE_MAX_BYTES = int(os.environ.get('PRECOMPILE_MAX_BYTES', str(256 * 1024)))  # Larger sources compile in the child
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')  # Required (as X-Admin-Token) for ?profile=1 and stats listings; unset disables them
+PROFILE_DIR = os.path.join(DATA_DIR, 'profiles')
+REQUEST_LOG = os.environ.get('REQUEST_LOG', '1') == '1'  # One JSON log line per request
+DB_SYNCHRONOUS = os.environ.get('DB_SYNCHRONOUS', 'NORMAL')  # FULL fsyncs each commit; batching amortizes it
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get('GROUP_COMMIT_MAX_BATCH', '64'))  # Writes per shared transaction
 
-# Ensure tmp directory exists
-os.makedirs('/tmp', exist_ok=True)
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Version history: /api/update keeps older versions as reverse deltas against
+# the next newer one, with a full copy at least every VERSION_CHECKPOINT_INTERVAL
+# versions so rebuilding any of them applies a bounded number of deltas
+VERSION_MAX_HISTORY = int(os.environ.get('VERSION_MAX_HISTORY', '50'))  # Older versions kept per paste; 0 keeps none
+VERSION_CHECKPOINT_INTERVAL = int(os.environ.get('VERSION_CHECKPOINT_INTERVAL', '16'))  # Most deltas per rebuild
+VERSION_DELTA_MAX_BYTES = int(os.environ.get('VERSION_DELTA_MAX_BYTES', str(8 * 1024 * 1024)))  # Larger: full copies
+VERSION_DIFF_MAX_BYTES = 1024 * 1024  # Changed regions above this are stored whole rather than line-diffed
+VERSION_CACHE_FOLDER = os.path.join(UPLOAD_FOLDER, 'versions')  # Rebuilt versions, served and run from here
+VERSION_CACHE_TTL = int(os.environ.get('VERSION_CACHE_TTL', '3600'))  # Seconds an unused rebuilt version is kept
 
-# Initialize JSON files if they don't exist
-for json_file in [PASSWORD_FILE, DATA_FILE]:
-    if not os.path.exists(json_file):
-        with open(json_file, 'w') as f:
-            json.dump({}, f)
+# Code execution
+PYTHON_EXECUTABLE = sys.executable  # Same interpreter as the server, so its version is known
+EXEC_TIMEOUT = 10
+# Per-run rlimits, set in the child before the script starts; 0 disables one
+EXEC_CPU_LIMIT = int(os.environ.get('EXEC_CPU_LIMIT', str(EXEC_TIMEOUT)))  # CPU seconds (RLIMIT_CPU)
+EXEC_MEMORY_LIMIT = int(os.environ.get('EXEC_MEMORY_LIMIT', str(512 * 1024 * 1024)))  # Address space bytes (RLIMIT_AS)
+EXEC_MAX_OPEN_FILES = int(os.environ.get('EXEC_MAX_OPEN_FILES', '64'))  # RLIMIT_NOFILE
+# Processes and threads per run, enforced by giving each run its own cgroup
+# under EXEC_CGROUP (a directory of the pids controller, cgroup v1 or v2, that
+# the server may create subgroups in); without one, runs have no process cap
+EXEC_MAX_PROCESSES = int(os.environ.get('EXEC_MAX_PROCESSES', '64'))
+EXEC_CGROUP = os.environ.get('EXEC_CGROUP', '')
+# RLIMIT_NPROC counts every process and thread of the real UID, the server's
+# own included, so it only suits runs under a dedicated user
+EXEC_USER_NPROC = int(os.environ.get('EXEC_USER_NPROC', '0'))
+EXEC_LIMITS = {'cpu': EXEC_CPU_LIMIT, 'as': EXEC_MEMORY_LIMIT, 'nofile': EXEC_MAX_OPEN_FILES, 'nproc': EXEC_USER_NPROC,
+               'pids': EXEC_MAX_PROCESSES if EXEC_CGROUP else 0, 'cgroup': EXEC_CGROUP}
+EXEC_CACHE_TTL = int(os.environ.get('EXEC_CACHE_TTL', '300'))
+EXEC_CACHE_MAX_ENTRIES = int(os.environ.get('EXEC_CACHE_MAX_ENTRIES', '1024'))
+EXEC_CACHE_MAX_BYTES = int(os.environ.get('EXEC_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+EXEC_POOL_SIZE = int(os.environ.get('EXEC_POOL_SIZE', '2'))  # 0 disables the warm pool
+EXEC_POOL_MAX_JOBS = int(os.environ.get('EXEC_POOL_MAX_JOBS', '100'))  # Recycle a worker after N runs
+EXEC_FRESH_CONCURRENCY = int(os.environ.get('EXEC_FRESH_CONCURRENCY', str(os.cpu_count() or 1)))  # Runs in new interpreters at once
+EXEC_POOL_PRELOAD = os.environ.get(
+    'EXEC_POOL_PRELOAD', 'json,re,collections,datetime,math,random,itertools,functools,traceback'
+)
+EXEC_STREAM_MAX_BYTES = int(os.environ.get('EXEC_STREAM_MAX_BYTES', str(1024 * 1024)))  # ?stream= output cap
+EXEC_ASYNC_CONCURRENCY = int(os.environ.get('EXEC_ASYNC_CONCURRENCY', '64'))  # In-flight runs under asgi_app
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', '32'))  # Threads running the WSGI app under asgi_app
+EXEC_JOB_CONCURRENCY = int(os.environ.get('EXEC_JOB_CONCURRENCY', str(max(EXEC_POOL_SIZE, 1))))
+EXEC_JOB_MAX_QUEUED = int(os.environ.get('EXEC_JOB_MAX_QUEUED', '100'))
+EXEC_JOB_POLICY = os.environ.get('EXEC_JOB_POLICY', 'fifo')  # 'fifo' or 'fair' (round-robin per client)
+EXEC_JOB_RETENTION = int(os.environ.get('EXEC_JOB_RETENTION', '600'))  # Seconds to keep finished jobs
+EXEC_MAX_WAITING = int(os.environ.get('EXEC_MAX_WAITING', '16'))  # Runs waiting for a slot before execute sheds with 503; 0 disables
 
-# Utility functions
-def load_data():
+# Admission control: token buckets checked before a route does any work. Each
+# limit is 'N/S' (bursts of up to N requests, refilled at N per S seconds);
+# empty or 0 disables it. 'client' buckets are per client_id(), 'global' ones
+# are shared by all clients.
+RATE_LIMITING = os.environ.get('RATE_LIMITING', '1') == '1'
+RATE_LIMITS = {
+    'execute': {'client': os.environ.get('RATE_LIMIT_EXECUTE', '60/60'),
+                'global': os.environ.get('RATE_LIMIT_EXECUTE_GLOBAL', '600/60')},
+    'upload': {'client': os.environ.get('RATE_LIMIT_UPLOAD', '30/60'),
+               'global': os.environ.get('RATE_LIMIT_UPLOAD_GLOBAL', '300/60')},
+}
+RATE_LIMITED_ENDPOINTS = {'execute_file': 'execute', 'upload_file': 'upload', 'upload_batch': 'upload',
+                          'update_file': 'upload'}
+RATE_LIMIT_MAX_CLIENTS = int(os.environ.get('RATE_LIMIT_MAX_CLIENTS', '100000'))  # Buckets kept in memory
+# Proxies in front of the app that append to X-Forwarded-For. The entries before
+# theirs are whatever the client sent, so with 0 only the peer address is trusted.
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', '0'))
+
+# Legacy JSON stores, imported into the database once on startup
+PASSWORD_FILE = os.path.join(DATA_DIR, 'passwords.json')
+DATA_FILE = os.path.join(DATA_DIR, 'files.json')
+
+# Metadata storage (SQLite in WAL mode, one connection per thread)
+_db_local = threading.local()
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    file_id TEXT PRIMARY KEY,
+    is_private INTEGER NOT NULL DEFAULT 0,
+    info TEXT NOT NULL,
+    original_name TEXT NOT NULL DEFAULT '',
+    upload_time TEXT NOT NULL DEFAULT '',
+    size_bytes INTEGER NOT NULL DEFAULT 0,
+    expires_at REAL,
+    last_access REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS passwords (
+    file_id TEXT PRIMARY KEY,
+    password_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    size_bytes INTEGER NOT NULL,
+    refcount INTEGER NOT NULL,
+    encoding TEXT NOT NULL DEFAULT 'identity'
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+-- Older versions of each paste: either a full copy (blob_hash holds a counted
+-- blob reference) or a delta that rebuilds it from version + 1
+CREATE TABLE IF NOT EXISTS versions (
+    file_id TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    content_hash TEXT NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    original_name TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    blob_hash TEXT,
+    delta BLOB,
+    PRIMARY KEY (file_id, version)
+);
+CREATE TABLE IF NOT EXISTS execution_stats (
+    file_id TEXT PRIMARY KEY,
+    runs INTEGER NOT NULL DEFAULT 0,
+    failures INTEGER NOT NULL DEFAULT 0,
+    timeouts INTEGER NOT NULL DEFAULT 0,
+    cpu_seconds REAL NOT NULL DEFAULT 0,
+    max_cpu_seconds REAL NOT NULL DEFAULT 0,
+    max_rss_kb INTEGER NOT NULL DEFAULT 0,
+    wall_seconds REAL NOT NULL DEFAULT 0,
+    last_run REAL
+);
+'''
+
+# Listing indexes: is_private first so public pages are one contiguous range,
+# file_id last as the tie-breaker that keeps cursors unambiguous
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS files_by_time ON files (is_private, upload_time, file_id);
+CREATE INDEX IF NOT EXISTS files_by_size ON files (is_private, size_bytes, file_id);
+CREATE INDEX IF NOT EXISTS files_by_name ON files (is_private, original_name, file_id);
+CREATE INDEX IF NOT EXISTS files_by_expiry ON files (expires_at) WHERE expires_at IS NOT NULL;
+CREATE INDEX IF NOT EXISTS files_by_access ON files (last_access);
+'''
+
+# Columns copied out of the info JSON so the listing and sweeper indexes can cover them
+FILE_ROW_SQL = ('(file_id, is_private, original_name, upload_time, size_bytes, expires_at, last_access, info) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)')
+
+def _file_row(file_id, file_info, last_access=None):
+    expires_at = file_info.get('expires_at')
+    return (
+        file_id,
+        int(bool(file_info.get('is_private'))),
+        file_info.get('original_name', ''),
+        file_info.get('upload_time', ''),
+        file_info.get('size_bytes', 0),
+        datetime.fromisoformat(expires_at).timestamp() if expires_at else None,
+        time.time() if last_access is None else last_access,
+        json.dumps(file_info)
+    )
+
+def _connect():
+    import sqlite3
+    conn = sqlite3.connect(DB_FILE, timeout=30, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(f'PRAGMA synchronous={DB_SYNCHRONOUS}')
+    return conn
+
+def get_db():
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        init_storage()
+        conn = _connect()
+        _db_local.conn = conn
+    return conn
+
+class _PendingWrite:
+    __slots__ = ('fn', 'invalidate', 'result', 'error', 'finished', 'wake')
+    
+    def __init__(self, fn, invalidate):
+        self.fn = fn
+        self.invalidate = invalidate
+        self.result = None
+        self.error = None
+        self.finished = False
+        self.wake = threading.Event()
+
+class GroupCommitter:
+    """Batches concurrent writers in this process into a single commit
+    
+    The first writer to arrive leads: it takes everything queued so far, runs
+    each mutation inside its own savepoint (so a failing mutation only undoes
+    itself), commits once and bumps the generation once. Writers arriving
+    meanwhile queue up for the next batch, led by the oldest of them. Other
+    processes are serialized by SQLite's write lock as before.
+    """
+    
+    def __init__(self, max_batch):
+        self.max_batch = max(max_batch, 1)
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._leading = False
+        self._local = threading.local()
+        self.batches = 0
+        self.writes = 0
+        self.largest_batch = 0
+    
+    def submit(self, fn, invalidate=True):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            # Called from inside a mutation: join the transaction already open
+            conn.execute('SAVEPOINT nested_write')
+            try:
+                result = fn(conn)
+            except BaseException:
+                conn.execute('ROLLBACK TO nested_write')
+                conn.execute('RELEASE nested_write')
+                raise
+            conn.execute('RELEASE nested_write')
+            return result
+        
+        pending = _PendingWrite(fn, invalidate)
+        with self._lock:
+            self._queue.append(pending)
+            lead = not self._leading
+            self._leading = True
+        if not lead:
+            pending.wake.wait()
+        if not pending.finished:
+            # Either first in, or handed the lead by the previous batch
+            self._commit_batch()
+        
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+    
+    def _commit_batch(self):
+        with self._lock:
+            batch = [self._queue.popleft() for _ in range(min(len(self._queue), self.max_batch))]
+        
+        conn = None
+        try:
+            # Inside the try, so a storage error still reaches every waiter and hands on the lead
+            conn = get_db()
+            self._local.conn = conn
+            conn.execute('BEGIN IMMEDIATE')
+            for pending in batch:
+                conn.execute('SAVEPOINT write')
+                try:
+                    pending.result = pending.fn(conn)
+                except Exception as e:
+                    conn.execute('ROLLBACK TO write')
+                    pending.error = e
+                conn.execute('RELEASE write')
+            conn.execute('COMMIT')
+        except BaseException as e:
+            if conn is not None and conn.in_transaction:
+                conn.execute('ROLLBACK')
+            for pending in batch:
+                pending.result = None
+                pending.error = pending.error or e
+        else:
+            # The writes are committed; failing to invalidate caches doesn't undo them
+            if any(pending.error is None and pending.invalidate for pending in batch):
+                try:
+                    bump_generation()
+                except OSError:
+                    logger.exception('Could not bump the cache generation')
+        finally:
+            self._local.conn = None
+            with self._lock:
+                self.batches += 1
+                self.writes += len(batch)
+                self.largest_batch = max(self.largest_batch, len(batch))
+                if self._queue:
+                    self._queue[0].wake.set()
+                else:
+                    self._leading = False
+            for pending in batch:
+                pending.finished = True
+                pending.wake.set()
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'batches': self.batches,
+                'writes': self.writes,
+                'largest_batch': self.largest_batch,
+                'writes_per_commit': round(self.writes / self.batches, 2) if self.batches else 0.0
+            }
+
+group_committer = GroupCommitter(GROUP_COMMIT_MAX_BATCH)
+
+def write_transaction(fn, invalidate=True):
+    """Run fn(conn) inside a write transaction and return its result
+    
+    fn may share the transaction with other concurrent writers, but runs in
+    its own savepoint: if it raises, only its changes are rolled back. Pass
+    invalidate=False for writes no cached lookup depends on.
+    """
+    return group_committer.submit(fn, invalidate)
+
+# Process-local metadata cache, invalidated whenever any process commits a write
+def _generation_stamp():
     try:
-        with open(DATA_FILE, 'r') as f:
-            return json.load(f)
-    except:
-        return {}
+        st = os.stat(GENERATION_FILE)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def bump_generation():
+    """Replace the generation file so every worker's cache sees a new stamp"""
+    tmp_path = f"{GENERATION_FILE}.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, 'w') as f:
+        f.write(str(time.time_ns()))
+    os.replace(tmp_path, GENERATION_FILE)
 
-def load_passwords():
+class MetadataCache:
+    """Caches file metadata and password hashes until the generation file changes"""
+    
+    _MISSING = object()
+    
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._stamp = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+    
+    def get(self, key, loader):
+        stamp = _generation_stamp()
+        with self._lock:
+            if stamp != self._stamp:
+                if self._entries:
+                    self.invalidations += 1
+                self._entries.clear()
+                self._stamp = stamp
+            value = self._entries.get(key, self._MISSING)
+            if value is not self._MISSING:
+                self.hits += 1
+                return value
+            self.misses += 1
+        
+        value = loader()
+        
+        with self._lock:
+            # Drop the result if a write landed while we were loading it
+            if stamp == self._stamp:
+                if len(self._entries) >= self.max_entries:
+                    self._entries.pop(next(iter(self._entries)))
+                self._entries[key] = value
+        return value
+    
+    def clear(self):
+        """Drop every entry, as a write from another process would"""
+        with self._lock:
+            self._entries.clear()
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+metadata_cache = MetadataCache(METADATA_CACHE_MAX_ENTRIES)
+
+def _load_legacy_json(path):
     try:
-        with open(PASSWORD_FILE, 'r') as f:
-            return json.load(f)
-    except:
+        with open(path, 'r') as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
         return {}
 
-def save_data(data):
-    with open(DATA_FILE, 'w') as f:
-        json.dump(data, f, indent=2)
+def migrate_legacy_json(conn):
+    """Import files.json/passwords.json into the database (runs once)"""
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_migrated'").fetchone():
+        return False
+    
+    # last_access 0 leaves these to backfill_access_times(), which starts them from upload_time
+    for file_id, file_info in _load_legacy_json(DATA_FILE).items():
+        conn.execute(f'INSERT OR IGNORE INTO files {FILE_ROW_SQL}', _file_row(file_id, file_info, 0))
+    for file_id, password_hash in _load_legacy_json(PASSWORD_FILE).items():
+        conn.execute(
+            'INSERT OR IGNORE INTO passwords (file_id, password_hash) VALUES (?, ?)',
+            (file_id, password_hash)
+        )
+    
+    conn.execute("INSERT INTO meta (key, value) VALUES ('legacy_migrated', ?)",
+                 (datetime.now().isoformat(),))
+    return True
+
+def init_counters(conn):
+    """Seed the incrementally maintained counters from a full scan (runs once)"""
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'counters_initialized'").fetchone():
+        return False
+    
+    counters = dict.fromkeys(COUNTER_NAMES, 0)
+    for (info,) in conn.execute('SELECT info FROM files'):
+        for name, delta in _file_counter_deltas(json.loads(info), 1).items():
+            counters[name] += delta
+    counters['blob_bytes'] = conn.execute(
+        'SELECT COALESCE(SUM(size_bytes), 0) FROM blobs'
+    ).fetchone()[0]
+    
+    conn.executemany('INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)',
+                     counters.items())
+    conn.execute("INSERT INTO meta (key, value) VALUES ('counters_initialized', ?)",
+                 (datetime.now().isoformat(),))
+    return True
+
+def backfill_listing_columns(conn):
+    """Copy listing columns out of the info JSON for rows written before they existed (runs once)"""
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'listing_backfilled'").fetchone():
+        return False
+    
+    rows = []
+    for file_id, info in conn.execute('SELECT file_id, info FROM files'):
+        file_info = json.loads(info)
+        rows.append((file_info.get('original_name', ''), file_info.get('upload_time', ''),
+                     file_info.get('size_bytes', 0), file_id))
+    conn.executemany(
+        'UPDATE files SET original_name = ?, upload_time = ?, size_bytes = ? WHERE file_id = ?', rows
+    )
+    conn.execute("INSERT INTO meta (key, value) VALUES ('listing_backfilled', ?)",
+                 (datetime.now().isoformat(),))
+    return True
+
+def backfill_access_times(conn):
+    """Start pastes stored before access tracking from their upload time (runs once)"""
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'access_backfilled'").fetchone():
+        return False
+    
+    conn.execute(
+        "UPDATE files SET last_access = COALESCE((julianday(upload_time) - 2440587.5) * 86400.0, 0) "
+        "WHERE last_access = 0"
+    )
+    conn.execute("INSERT INTO meta (key, value) VALUES ('access_backfilled', ?)",
+                 (datetime.now().isoformat(),))
+    return True
+
+def _ensure_column(conn, table, column, definition):
+    """Add a column that CREATE TABLE IF NOT EXISTS can't add to an older database"""
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def init_db(conn):
+    """Create or upgrade the schema and run the one-off data migrations
+    
+    Uses its own connection and transaction rather than write_transaction(),
+    since it runs while get_db() is still waiting for it.
+    """
+    conn.executescript(SCHEMA)
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        _ensure_column(conn, 'blobs', 'encoding', "TEXT NOT NULL DEFAULT 'identity'")
+        _ensure_column(conn, 'files', 'original_name', "TEXT NOT NULL DEFAULT ''")
+        _ensure_column(conn, 'files', 'upload_time', "TEXT NOT NULL DEFAULT ''")
+        _ensure_column(conn, 'files', 'size_bytes', 'INTEGER NOT NULL DEFAULT 0')
+        _ensure_column(conn, 'files', 'expires_at', 'REAL')
+        _ensure_column(conn, 'files', 'last_access', 'REAL NOT NULL DEFAULT 0')
+        for statement in INDEXES.split(';'):
+            if statement.strip():
+                conn.execute(statement)
+        migrated = migrate_legacy_json(conn)
+        changed = [migrated, init_counters(conn), backfill_listing_columns(conn), backfill_access_times(conn)]
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+    if any(changed):
+        bump_generation()
+    
+    if migrated:
+        # Keep the old files around for rollback, but out of the way
+        for json_file in [DATA_FILE, PASSWORD_FILE]:
+            if os.path.exists(json_file):
+                try:
+                    os.replace(json_file, json_file + '.migrated')
+                except OSError:
+                    pass
+
+# Storage is set up on first use rather than at import, so a cold start that
+# only serves the upload page never touches the disk (nor starts the sweeper)
+_storage_ready = False
+_storage_lock = threading.Lock()
+
+def init_storage():
+    """Create the data directories and the database schema, once per process
+    
+    Also starts the storage sweeper, the first time anything needs storage.
+    """
+    global _storage_ready
+    if not _storage_ready:
+        with _storage_lock:
+            if not _storage_ready:
+                os.makedirs(DATA_DIR, exist_ok=True)
+                os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+                os.makedirs(BLOB_TMP_FOLDER, exist_ok=True)
+                conn = _connect()
+                try:
+                    init_db(conn)
+                finally:
+                    conn.close()
+                _storage_ready = True
+    storage_sweeper.start()
+
+# Utility functions
+def _load_file_info(file_id):
+    row = get_db().execute(
+        'SELECT info FROM files WHERE file_id = ?', (file_id,)
+    ).fetchone()
+    return json.loads(row[0]) if row else None
+
+def _load_password_hash(file_id):
+    row = get_db().execute(
+        'SELECT password_hash FROM passwords WHERE file_id = ?', (file_id,)
+    ).fetchone()
+    return row[0] if row else None
+
+def is_expired(file_info):
+    expires_at = file_info.get('expires_at')
+    return expires_at is not None and datetime.fromisoformat(expires_at) <= datetime.now()
+
+def get_file_info(file_id):
+    """Cached metadata lookup; callers must not mutate the returned dict
+    
+    Expired pastes read as missing even before the sweeper removes them.
+    """
+    file_info = metadata_cache.get(('file', file_id), lambda: _load_file_info(file_id))
+    if file_info is not None and is_expired(file_info):
+        return None
+    return file_info
+
+def get_password_hash(file_id):
+    return metadata_cache.get(('password', file_id), lambda: _load_password_hash(file_id))
+
+# Counters kept in step with every write, so /api/status never scans files
+COUNTER_NAMES = ('total_files', 'public_files', 'private_files', 'bytes_stored', 'blob_bytes')
+
+def _file_counter_deltas(file_info, sign):
+    private = bool(file_info.get('is_private'))
+    return {
+        'total_files': sign,
+        'public_files': 0 if private else sign,
+        'private_files': sign if private else 0,
+        'bytes_stored': sign * file_info.get('size_bytes', 0)
+    }
+
+def _bump_counters(conn, deltas):
+    for name, delta in deltas.items():
+        if delta:
+            conn.execute('UPDATE counters SET value = value + ? WHERE name = ?', (delta, name))
+
+def _load_counters():
+    return dict(get_db().execute('SELECT name, value FROM counters').fetchall())
+
+def get_counters():
+    return metadata_cache.get(('counters',), _load_counters)
+
+# Public listing, served from the files_by_* indexes with keyset pagination
+LIST_SORT_COLUMNS = {'upload_time': 'upload_time', 'size_bytes': 'size_bytes', 'filename': 'original_name'}
+LIST_DEFAULT_LIMIT = 50
+LIST_MAX_LIMIT = 200
+LIST_PREFIX_MAX_MATCHES = 5000  # Prefix matches sorted per page when not listing by filename
+
+def _load_listing(sort, descending, prefix, limit, after):
+    """Raises ValueError for a prefix too broad to list in any order but by filename"""
+    column = LIST_SORT_COLUMNS[sort]
+    db = get_db()
+    source = 'files'
+    clauses = ['is_private = 0', '(expires_at IS NULL OR expires_at > ?)']
+    params = [time.time()]
+    if prefix:
+        name_range = [prefix, prefix + '\U0010ffff']
+        if column == 'original_name':
+            # files_by_name answers both the range and the order
+            clauses.append('original_name >= ? AND original_name < ?')
+            params += name_range
+        else:
+            # Ordered by another index, SQLite would test names across the whole
+            # table; sorting the matches instead costs what the prefix matches,
+            # so that is capped
+            matches = ('SELECT * FROM files INDEXED BY files_by_name '
+                       'WHERE is_private = 0 AND original_name >= ? AND original_name < ?')
+            count = db.execute(f'SELECT COUNT(*) FROM ({matches} LIMIT ?)',
+                               name_range + [LIST_PREFIX_MAX_MATCHES + 1]).fetchone()[0]
+            if count > LIST_PREFIX_MAX_MATCHES:
+                raise ValueError(f'More than {LIST_PREFIX_MAX_MATCHES} pastes match this prefix; '
+                                 'use a longer prefix or sort=filename')
+            source = f'({matches})'
+            params = name_range + params
+    if after is not None:
+        clauses.append(f"({column}, file_id) {'<' if descending else '>'} (?, ?)")
+        params += list(after)
+    direction = 'DESC' if descending else 'ASC'
+    rows = db.execute(
+        f"SELECT file_id, original_name, upload_time, size_bytes, expires_at FROM {source} "
+        f"WHERE {' AND '.join(clauses)} ORDER BY {column} {direction}, file_id {direction} LIMIT ?",
+        params + [limit + 1]
+    ).fetchall()
+    expiries = [row[4] for row in rows if row[4] is not None]
+    return [
+        {'file_id': row[0], 'filename': row[1], 'upload_time': row[2], 'size_bytes': row[3]}
+        for row in rows
+    ], min(expiries, default=None)
+
+def list_public_files(sort='upload_time', descending=True, prefix='', limit=LIST_DEFAULT_LIMIT, after=None):
+    """One page of public pastes, plus one extra row if another page follows
+    
+    after is the (sort value, file_id) of the last row of the previous page.
+    Raises ValueError when the prefix is too broad (see _load_listing()).
+    A cached page is only good until the first paste on it expires: the
+    sweeper's delete invalidates it, but may not run for SWEEP_INTERVAL.
+    """
+    key = ('list', sort, descending, prefix, limit, tuple(after) if after else None)
+    rows, stale_at = metadata_cache.get(key, lambda: _load_listing(sort, descending, prefix, limit, after))
+    if stale_at is not None and stale_at <= time.time():
+        rows, _ = _load_listing(sort, descending, prefix, limit, after)
+    return rows
+
+def _write_file_info(conn, file_id, file_info, password_hash=None, blob=None):
+    row = conn.execute('SELECT info FROM files WHERE file_id = ?', (file_id,)).fetchone()
+    if blob is not None:
+        # A deduplicated blob keeps whatever encoding it was first stored with
+        file_info['encoding'] = _acquire_blob(conn, blob)
+    conn.execute(f'INSERT OR REPLACE INTO files {FILE_ROW_SQL}', _file_row(file_id, file_info))
+    if password_hash:
+        conn.execute(
+            'INSERT OR REPLACE INTO passwords (file_id, password_hash) VALUES (?, ?)',
+            (file_id, password_hash)
+        )
+    _bump_counters(conn, _file_counter_deltas(file_info, 1))
+    if row:
+        old_info = json.loads(row[0])
+        _bump_counters(conn, _file_counter_deltas(old_info, -1))
+        _release_content(conn, old_info)
+
+def save_file_info(file_id, file_info, password_hash=None, blob=None):
+    """Insert or replace one file's metadata (and password) atomically
+    
+    If blob is given its reference is taken in the same transaction, and the
+    blob (or legacy file) referenced by any previous version is released.
+    """
+    write_transaction(lambda conn: _write_file_info(conn, file_id, file_info, password_hash, blob))
+
+def save_files(entries):
+    """Save many files at once: all or none of them are committed
+    
+    entries are (file_id, file_info, password_hash, blob) tuples, as for
+    save_file_info().
+    """
+    def write(conn):
+        for entry in entries:
+            _write_file_info(conn, *entry)
+    write_transaction(write)
+
+def _delete_file(conn, file_id):
+    row = conn.execute('SELECT info FROM files WHERE file_id = ?', (file_id,)).fetchone()
+    if not row:
+        return False
+    conn.execute('DELETE FROM files WHERE file_id = ?', (file_id,))
+    conn.execute('DELETE FROM passwords WHERE file_id = ?', (file_id,))
+    conn.execute('DELETE FROM execution_stats WHERE file_id = ?', (file_id,))
+    for (blob_hash,) in conn.execute(
+        'SELECT blob_hash FROM versions WHERE file_id = ? AND blob_hash IS NOT NULL', (file_id,)
+    ).fetchall():
+        _release_blob(conn, blob_hash)
+    conn.execute('DELETE FROM versions WHERE file_id = ?', (file_id,))
+    old_info = json.loads(row[0])
+    _bump_counters(conn, _file_counter_deltas(old_info, -1))
+    _release_content(conn, old_info)
+    return True
+
+def delete_file(file_id):
+    """Remove a file's metadata and password and drop its blob reference"""
+    return write_transaction(lambda conn: _delete_file(conn, file_id))
+
+def delete_files(file_ids):
+    """Remove several files in one transaction; returns how many existed"""
+    return write_transaction(lambda conn: sum(_delete_file(conn, file_id) for file_id in file_ids))
+
+# Expiry, quota and LRU eviction
+class AccessTracker:
+    """Buffers last-access times in memory; the sweeper writes them out in batches"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+    
+    def touch(self, file_id):
+        with self._lock:
+            self._pending[file_id] = time.time()
+    
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if pending:
+            # Nothing cached depends on last_access, so caches stay valid
+            write_transaction(lambda conn: conn.executemany(
+                'UPDATE files SET last_access = ? WHERE file_id = ?',
+                [(accessed, file_id) for file_id, accessed in pending.items()]
+            ), invalidate=False)
+        return len(pending)
+
+access_tracker = AccessTracker()
+
+class ExecutionStatsTracker:
+    """Per-paste execution totals, buffered in memory and upserted by the sweeper"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+    
+    def record(self, file_id, returncode, timed_out, usage):
+        with self._lock:
+            stats = self._pending.get(file_id)
+            if stats is None:
+                stats = self._pending[file_id] = {
+                    'runs': 0, 'failures': 0, 'timeouts': 0, 'cpu_seconds': 0.0,
+                    'max_cpu_seconds': 0.0, 'max_rss_kb': 0, 'wall_seconds': 0.0
+                }
+            stats['runs'] += 1
+            stats['failures'] += returncode != 0 and not timed_out
+            stats['timeouts'] += timed_out
+            stats['cpu_seconds'] += usage['cpu_seconds']
+            stats['max_cpu_seconds'] = max(stats['max_cpu_seconds'], usage['cpu_seconds'])
+            stats['max_rss_kb'] = max(stats['max_rss_kb'], usage['peak_rss_kb'])
+            stats['wall_seconds'] += usage['wall_seconds']
+            stats['last_run'] = time.time()
+    
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if pending:
+            # Only for pastes that still exist; deleting a paste deletes its row
+            write_transaction(lambda conn: conn.executemany(
+                '''INSERT INTO execution_stats (file_id, runs, failures, timeouts, cpu_seconds,
+                                                 max_cpu_seconds, max_rss_kb, wall_seconds, last_run)
+                   SELECT ?, ?, ?, ?, ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM files WHERE file_id = ?)
+                   ON CONFLICT (file_id) DO UPDATE SET
+                       runs = runs + excluded.runs,
+                       failures = failures + excluded.failures,
+                       timeouts = timeouts + excluded.timeouts,
+                       cpu_seconds = cpu_seconds + excluded.cpu_seconds,
+                       max_cpu_seconds = max(max_cpu_seconds, excluded.max_cpu_seconds),
+                       max_rss_kb = max(max_rss_kb, excluded.max_rss_kb),
+                       wall_seconds = wall_seconds + excluded.wall_seconds,
+                       last_run = excluded.last_run''',
+                [(file_id, stats['runs'], stats['failures'], stats['timeouts'], stats['cpu_seconds'],
+                  stats['max_cpu_seconds'], stats['max_rss_kb'], stats['wall_seconds'], stats['last_run'], file_id)
+                 for file_id, stats in pending.items()]
+            ), invalidate=False)
+        return len(pending)
+
+execution_stats = ExecutionStatsTracker()
+
+EXECUTION_STATS_SORT_COLUMNS = ('cpu_seconds', 'max_cpu_seconds', 'max_rss_kb', 'wall_seconds', 'runs', 'timeouts')
+
+def _execution_stats_row(row):
+    file_id, original_name, runs, failures, timeouts, cpu_seconds, max_cpu_seconds, max_rss_kb, wall_seconds, last_run = row
+    return {
+        'file_id': file_id,
+        'filename': original_name,
+        'runs': runs,
+        'failures': failures,
+        'timeouts': timeouts,
+        'cpu_seconds': round(cpu_seconds, 4),
+        'avg_cpu_seconds': round(cpu_seconds / runs, 4) if runs else 0.0,
+        'max_cpu_seconds': round(max_cpu_seconds, 4),
+        'max_rss_kb': max_rss_kb,
+        'wall_seconds': round(wall_seconds, 4),
+        'avg_wall_seconds': round(wall_seconds / runs, 4) if runs else 0.0,
+        'last_run': datetime.fromtimestamp(last_run).isoformat() if last_run else None
+    }
+
+def load_execution_stats(file_id=None, sort='cpu_seconds', limit=50):
+    """Stats for one paste (dict or None), or the most expensive pastes by sort (list)"""
+    execution_stats.flush()
+    query = ('''SELECT s.file_id, f.original_name, s.runs, s.failures, s.timeouts, s.cpu_seconds,
+                      s.max_cpu_seconds, s.max_rss_kb, s.wall_seconds, s.last_run
+               FROM execution_stats s JOIN files f ON f.file_id = s.file_id''')
+    conn = get_db()
+    if file_id is not None:
+        row = conn.execute(f'{query} WHERE s.file_id = ?', (file_id,)).fetchone()
+        return _execution_stats_row(row) if row else None
+    # sort is checked against EXECUTION_STATS_SORT_COLUMNS by the caller
+    rows = conn.execute(f'{query} ORDER BY s.{sort} DESC, s.file_id LIMIT ?', (limit,)).fetchall()
+    return [_execution_stats_row(row) for row in rows]
+
+class StorageSweeper:
+    """Background thread that removes expired pastes and enforces the quota
+    
+    Work is done SWEEP_BATCH pastes per transaction, so requests never wait
+    behind one long delete. Every process runs its own sweeper; deletes are
+    idempotent, so sweepers racing each other is harmless.
+    """
+    
+    def __init__(self, interval, batch_size, quota_bytes):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.quota_bytes = quota_bytes
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.expired = 0
+        self.evicted = 0
+        self.last_run = None
+    
+    def start(self):
+        """Start the thread if it isn't running in this process (cheap to call again)"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+    
+    def wake(self):
+        self._wake.set()
+    
+    def over_quota(self):
+        return self.quota_bytes > 0 and get_counters()['blob_bytes'] > self.quota_bytes
+    
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception('Storage sweep failed')
+    
+    def sweep(self):
+        access_tracker.flush()
+        execution_stats.flush()
+        
+        conn = get_db()
+        while True:
+            file_ids = [row[0] for row in conn.execute(
+                'SELECT file_id FROM files WHERE expires_at <= ? LIMIT ?', (time.time(), self.batch_size)
+            )]
+            if not file_ids:
+                break
+            self.expired += delete_files(file_ids)
+        
+        # Least recently used first, just enough of them to cover the excess
+        while self.over_quota():
+            excess = get_counters()['blob_bytes'] - self.quota_bytes
+            file_ids = []
+            for file_id, size_bytes in conn.execute(
+                'SELECT file_id, size_bytes FROM files ORDER BY last_access LIMIT ?', (self.batch_size,)
+            ).fetchall():
+                file_ids.append(file_id)
+                excess -= size_bytes
+                if excess <= 0:
+                    break
+            if not file_ids:
+                break
+            self.evicted += delete_files(file_ids)
+        
+        prune_version_cache()
+        prune_run_cgroups()
+        
+        self.runs += 1
+        self.last_run = datetime.now().isoformat()
+    
+    def stats(self):
+        return {
+            'running': self._thread is not None and self._thread.is_alive(),
+            'runs': self.runs,
+            'expired': self.expired,
+            'evicted': self.evicted,
+            'last_run': self.last_run,
+            'quota_bytes': self.quota_bytes
+        }
+
+storage_sweeper = StorageSweeper(SWEEP_INTERVAL, SWEEP_BATCH, STORAGE_QUOTA_BYTES)
+
+def parse_ttl(value):
+    """Expiry time (ISO string) for a ttl in seconds, or None to keep the paste"""
+    if value is None or str(value).strip() == '':
+        ttl = PASTE_DEFAULT_TTL or PASTE_MAX_TTL
+    else:
+        try:
+            ttl = int(str(value).strip())
+        except ValueError:
+            ttl = -1
+        if ttl <= 0:
+            raise ValueError('ttl must be a positive number of seconds')
+        if PASTE_MAX_TTL and ttl > PASTE_MAX_TTL:
+            raise ValueError(f'ttl may be at most {PASTE_MAX_TTL} seconds')
+    if not ttl:
+        return None
+    return (datetime.now() + timedelta(seconds=ttl)).isoformat()
+
+# Content-addressed blob storage
+#
+# Blob files are only created (renamed into place) or unlinked inside a write
+# transaction, so the refcount in the blobs table and the files on disk can't
+# race with each other across workers.
+class StagedBlob:
+    """Content that has been hashed and, unless already stored, written to a temp file"""
+    
+    def __init__(self, blob_hash, size_bytes, temp_path=None, content=None, encoding='identity'):
+        self.hash = blob_hash
+        self.size_bytes = size_bytes
+        self.temp_path = temp_path
+        self.content = content
+        self.encoding = encoding  # Of temp_path; content is always identity
+    
+    def discard(self):
+        if self.temp_path and os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+        self.temp_path = None
+
+def blob_path(blob_hash, encoding='identity'):
+    path = os.path.join(BLOB_FOLDER, blob_hash[:2], blob_hash)
+    return path + '.gz' if encoding == 'gzip' else path
+
+def open_blob(path, encoding='identity'):
+    """Open a stored or staged blob for reading its uncompressed bytes"""
+    import gzip
+    return gzip.open(path, 'rb') if encoding == 'gzip' else open(path, 'rb')
+
+def blob_exists(blob_hash):
+    return get_db().execute(
+        'SELECT 1 FROM blobs WHERE hash = ?', (blob_hash,)
+    ).fetchone() is not None
+
+def _new_temp_path():
+    init_storage()
+    return os.path.join(BLOB_TMP_FOLDER, uuid.uuid4().hex)
+
+def stage_blob(content):
+    """Hash content and write it to a temp file only if the hash is unknown"""
+    blob_hash = hashlib.sha256(content).hexdigest()
+    if blob_exists(blob_hash):
+        return StagedBlob(blob_hash, len(content), content=content)
+    
+    temp_path = _new_temp_path()
+    with open(temp_path, 'wb') as f:
+        f.write(content)
+    return StagedBlob(blob_hash, len(content), temp_path=temp_path, content=content)
+
+class BlobWriter:
+    """Writes streamed content to a temp file while hashing it"""
+    
+    def __init__(self):
+        self.temp_path = _new_temp_path()
+        self._file = open(self.temp_path, 'wb')
+        self._hash = hashlib.sha256()
+        self.size_bytes = 0
+    
+    def write(self, chunk):
+        self._hash.update(chunk)
+        self._file.write(chunk)
+        self.size_bytes += len(chunk)
+    
+    def finish(self):
+        self._file.close()
+        return StagedBlob(self._hash.hexdigest(), self.size_bytes, temp_path=self.temp_path)
+    
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+def stage_blob_stream(stream, chunk_size=UPLOAD_CHUNK_SIZE):
+    """Stage content read from a file-like stream, one chunk at a time"""
+    writer = BlobWriter()
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            writer.write(chunk)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.finish()
+
+def compress_blob(blob):
+    """Replace a staged blob's temp file with a gzip copy if that saves space
+    
+    Blobs that are already stored (no temp file) are left alone, and so are
+    small or incompressible ones. The gzip header carries no name or mtime, so
+    the same content always compresses to the same bytes.
+    """
+    if (BLOB_COMPRESSION != 'gzip' or not blob.temp_path or blob.encoding != 'identity'
+            or blob.size_bytes < BLOB_COMPRESSION_MIN_SIZE):
+        return
+    
+    import gzip
+    temp_path = _new_temp_path()
+    with open(blob.temp_path, 'rb') as src, open(temp_path, 'wb') as raw:
+        with gzip.GzipFile(filename='', mode='wb', fileobj=raw,
+                           compresslevel=BLOB_COMPRESSION_LEVEL, mtime=0) as dst:
+            while True:
+                chunk = src.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                dst.write(chunk)
+    
+    if os.path.getsize(temp_path) < blob.size_bytes * 0.9:
+        os.remove(blob.temp_path)
+        blob.temp_path = temp_path
+        blob.encoding = 'gzip'
+    else:
+        os.remove(temp_path)
+
+def _acquire_blob(conn, blob):
+    """Take a reference to blob, storing it if new; returns its stored encoding"""
+    cursor = conn.execute(
+        'UPDATE blobs SET refcount = refcount + 1 WHERE hash = ?', (blob.hash,)
+    )
+    if cursor.rowcount:
+        blob.discard()
+        return conn.execute('SELECT encoding FROM blobs WHERE hash = ?', (blob.hash,)).fetchone()[0]
+    
+    if blob.temp_path:
+        path = blob_path(blob.hash, blob.encoding)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(blob.temp_path, path)
+        blob.temp_path = None
+    else:
+        # The blob was released between staging and this transaction
+        blob.encoding = 'identity'
+        path = blob_path(blob.hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = _new_temp_path()
+        with open(temp_path, 'wb') as f:
+            f.write(blob.content)
+        os.replace(temp_path, path)
+    conn.execute(
+        'INSERT INTO blobs (hash, size_bytes, refcount, encoding) VALUES (?, ?, 1, ?)',
+        (blob.hash, blob.size_bytes, blob.encoding)
+    )
+    _bump_counters(conn, {'blob_bytes': blob.size_bytes})
+    return blob.encoding
+
+def _retain_blob(conn, blob_hash):
+    """Take another reference to a stored blob"""
+    conn.execute('UPDATE blobs SET refcount = refcount + 1 WHERE hash = ?', (blob_hash,))
+
+def _release_blob(conn, blob_hash):
+    conn.execute('UPDATE blobs SET refcount = refcount - 1 WHERE hash = ?', (blob_hash,))
+    row = conn.execute('SELECT refcount, size_bytes FROM blobs WHERE hash = ?', (blob_hash,)).fetchone()
+    if row and row[0] <= 0:
+        conn.execute('DELETE FROM blobs WHERE hash = ?', (blob_hash,))
+        _bump_counters(conn, {'blob_bytes': -row[1]})
+        for path in (blob_path(blob_hash), blob_path(blob_hash, 'gzip'), bytecode_path(blob_hash)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def _release_content(conn, old_info):
+    if old_info.get('blob_hash'):
+        _release_blob(conn, old_info['blob_hash'])
+    elif old_info.get('saved_name'):
+        # Pre-dedup upload stored as UPLOAD_FOLDER/{file_id}_{filename}
+        old_path = os.path.join(UPLOAD_FOLDER, old_info['saved_name'])
+        if os.path.exists(old_path):
+            os.remove(old_path)
+
+def gunzip_chunks(path, chunk_size=UPLOAD_CHUNK_SIZE):
+    """Yield the uncompressed content of a gzip blob, one chunk at a time"""
+    import gzip
+    with gzip.open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+def _archive_member_name(file_id, file_info):
+    # Names can repeat across pastes, so each one gets its own directory
+    return f"{file_id}/{file_info['original_name']}"
+
+def _archive_member_mtime(file_info):
+    return datetime.fromisoformat(file_info['upload_time']).timestamp()
+
+def tar_stream(entries, chunk_size=UPLOAD_CHUNK_SIZE):
+    """Yield a tar archive of (file_id, file_info) entries, one chunk at a time"""
+    import tarfile
+    for file_id, file_info in entries:
+        member = tarfile.TarInfo(_archive_member_name(file_id, file_info))
+        member.size = file_info['size_bytes']
+        member.mtime = int(_archive_member_mtime(file_info))
+        member.mode = 0o644
+        yield member.tobuf(tarfile.PAX_FORMAT)
+        with open_blob(content_path(file_info), file_info.get('encoding', 'identity')) as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        if member.size % tarfile.BLOCKSIZE:
+            yield tarfile.NUL * (tarfile.BLOCKSIZE - member.size % tarfile.BLOCKSIZE)
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+class _ChunkSink:
+    """Write-only file that collects output until it is drained"""
+    
+    def __init__(self):
+        self._chunks = []
+    
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def zip_stream(entries, chunk_size=UPLOAD_CHUNK_SIZE):
+    """Yield a zip archive of (file_id, file_info) entries, one chunk at a time
+    
+    The sink isn't seekable, so zipfile writes sizes in data descriptors
+    after each member instead of going back to patch the local headers.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for file_id, file_info in entries:
+            member = zipfile.ZipInfo(_archive_member_name(file_id, file_info),
+                                     time.localtime(_archive_member_mtime(file_info))[:6])
+            member.compress_type = zipfile.ZIP_DEFLATED
+            member.external_attr = 0o644 << 16
+            with open_blob(content_path(file_info), file_info.get('encoding', 'identity')) as src, \
+                    archive.open(member, 'w') as dest:
+                while True:
+                    chunk = src.read(chunk_size)
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            # Never yield b'': some servers treat an empty chunk as end of body
+            data = sink.drain()
+            if data:
+                yield data
+    yield sink.drain()  # The central directory
+
+def content_path(file_info):
+    """Path of the stored content for a metadata entry"""
+    if file_info.get('blob_hash'):
+        return blob_path(file_info['blob_hash'], file_info.get('encoding', 'identity'))
+    return os.path.join(UPLOAD_FOLDER, file_info['saved_name'])
+
+# Bytecode cache: blobs are compiled once at upload, next to the blob itself
+def bytecode_path(blob_hash):
+    return f"{blob_path(blob_hash)}.{sys.implementation.cache_tag}.pyc"
+
+def _stored_encoding(blob_hash):
+    row = get_db().execute('SELECT encoding FROM blobs WHERE hash = ?', (blob_hash,)).fetchone()
+    return row[0] if row else 'identity'
+
+def precompile_blob(blob):
+    """Compile a staged blob to bytecode; returns a syntax_error dict or None
+    
+    The code object's filename is the uncompressed blob path, so tracebacks
+    look the same as when the source file itself is run (for gzip blobs the
+    runner supplies the source lines itself). Sources over PRECOMPILE_MAX_BYTES
+    are left alone: compiling them would hold the request for seconds, so the
+    sandboxed child compiles them when they run instead.
+    """
+    pyc_path = bytecode_path(blob.hash)
+    if os.path.exists(pyc_path) or blob.size_bytes > PRECOMPILE_MAX_BYTES:
+        return None
+    
+    if blob.temp_path:
+        source_file = open_blob(blob.temp_path, blob.encoding)
+    else:
+        encoding = _stored_encoding(blob.hash)
+        source_file = open_blob(blob_path(blob.hash, encoding), encoding)
+    with source_file:
+        source = source_file.read()
+    
+    try:
+        code = compile(source, blob_path(blob.hash), 'exec', dont_inherit=True)
+    except (SyntaxError, ValueError, RecursionError, MemoryError) as e:
+        # Deeply nested or huge expressions exhaust the compiler rather than parse badly
+        return {
+            'type': type(e).__name__,
+            'lineno': getattr(e, 'lineno', None),
+            'message': ''.join(traceback.format_exception_only(type(e), e))
+        }
+    
+    # Unchecked-hash pyc header: nothing ever revalidates it against the source
+    temp_pyc = _new_temp_path()
+    with open(temp_pyc, 'wb') as f:
+        f.write(importlib.util.MAGIC_NUMBER)
+        f.write((0b01).to_bytes(4, 'little'))
+        f.write(importlib.util.source_hash(source))
+        f.write(marshal.dumps(code))
+    os.makedirs(os.path.dirname(pyc_path), exist_ok=True)
+    os.replace(temp_pyc, pyc_path)
+    return None
+
+def executable_path(file_info):
+    """The cached bytecode for a file, compiling it if missing, otherwise its source"""
+    if file_info.get('blob_hash'):
+        pyc_path = bytecode_path(file_info['blob_hash'])
+        if os.path.exists(pyc_path):
+            return pyc_path
+        # e.g. stored before an interpreter upgrade changed the cache tag
+        try:
+            precompile_blob(StagedBlob(file_info['blob_hash'], file_info['size_bytes']))
+        except OSError:
+            pass
+        if os.path.exists(pyc_path):
+            return pyc_path
+    return content_path(file_info)
+
+# Upload request parsing (JSON + base64, multipart/form-data, raw octet-stream)
+class UploadError(ValueError):
+    pass
+
+def _form_flag(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+class _MultipartUpload:
+    """python-multipart callbacks: 'file' parts are streamed into BlobWriters"""
+    
+    def __init__(self, max_files=1):
+        self.fields = {}
+        self.files = []  # (filename, StagedBlob)
+        self.max_files = max_files
+        self._header_field = b''
+        self._header_value = b''
+        self._headers = {}
+        self._name = None
+        self._value = None
+        self._writer = None
+        self._file_name = ''
+    
+    def callbacks(self):
+        return {
+            'on_part_begin': self.on_part_begin,
+            'on_part_data': self.on_part_data,
+            'on_part_end': self.on_part_end,
+            'on_header_field': self.on_header_field,
+            'on_header_value': self.on_header_value,
+            'on_header_end': self.on_header_end,
+            'on_headers_finished': self.on_headers_finished,
+        }
+    
+    def on_part_begin(self):
+        self._headers = {}
+        self._name = None
+        self._value = None
+    
+    def on_header_field(self, data, start, end):
+        self._header_field += data[start:end]
+    
+    def on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+    
+    def on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b''
+        self._header_value = b''
+    
+    def on_headers_finished(self):
+        from multipart.multipart import parse_options_header
+        _, options = parse_options_header(self._headers.get(b'content-disposition', b''))
+        self._name = options.get(b'name', b'').decode('utf-8', 'replace')
+        if self._name in ('file', 'files') and b'filename' in options:
+            if len(self.files) >= self.max_files:
+                raise UploadError('Only one file per upload' if self.max_files == 1
+                                  else f'At most {self.max_files} files per batch')
+            self._file_name = options[b'filename'].decode('utf-8', 'replace')
+            self._writer = BlobWriter()
+        else:
+            self._value = bytearray()
+    
+    def on_part_data(self, data, start, end):
+        if self._writer is not None:
+            self._writer.write(data[start:end])
+        elif self._value is not None:
+            self._value += data[start:end]
+            if len(self._value) > UPLOAD_MAX_FIELD_SIZE:
+                raise UploadError(f'Form field too large: {self._name}')
+    
+    def on_part_end(self):
+        if self._writer is not None:
+            self.files.append((self._file_name, self._writer.finish()))
+            self._writer = None
+        elif self._value is not None and self._name:
+            self.fields[self._name] = self._value.decode('utf-8', 'replace')
+        self._value = None
+    
+    def abort(self):
+        if self._writer is not None:
+            self._writer.abort()
+        for _, blob in self.files:
+            blob.discard()
+
+def parse_multipart_upload(stream, content_type, max_files=1, chunk_size=UPLOAD_CHUNK_SIZE):
+    """Stream a multipart/form-data body; returns (fields, [(filename, StagedBlob)])"""
+    from multipart.multipart import MultipartParser, parse_options_header
+    from multipart.exceptions import MultipartParseError
+    _, options = parse_options_header(content_type)
+    boundary = options.get(b'boundary')
+    if not boundary:
+        raise UploadError('Missing multipart boundary')
+    
+    upload = _MultipartUpload(max_files)
+    parser = MultipartParser(boundary, upload.callbacks())
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            parser.write(chunk)
+        parser.finalize()
+    except MultipartParseError as e:
+        upload.abort()
+        raise UploadError(f'Invalid multipart body: {e}')
+    except BaseException:
+        upload.abort()
+        raise
+    
+    return upload.fields, upload.files
+
+def read_upload_request():
+    """Read upload fields and stage the content for any supported request format
+    
+    Returns (fields, blob) where fields has filename/password/is_private and
+    blob is a StagedBlob, or None if no content was sent. The caller owns the
+    blob and must discard() it.
+    """
+    mimetype = request.mimetype
+    
+    if mimetype == 'multipart/form-data':
+        with timed('stream'):
+            fields, files = parse_multipart_upload(request.stream, request.headers.get('Content-Type', ''))
+        blob = None
+        if files:
+            fields.setdefault('filename', files[0][0])
+            blob = files[0][1]
+    elif mimetype == 'application/octet-stream':
+        fields = request.args.to_dict()
+        if request.headers.get('X-Paste-Password'):
+            fields['password'] = request.headers['X-Paste-Password']
+        with timed('stream'):
+            blob = stage_blob_stream(request.stream)
+    else:
+        with timed('json'):
+            data = request.get_json()
+        if not data:
+            raise UploadError('No data provided')
+        fields = {
+            'filename': data.get('filename', ''),
+            'password': data.get('password', ''),
+            'is_private': data.get('is_private', False),
+            'ttl': data.get('ttl', ''),
+            'base_hash': data.get('base_hash', ''),
+        }
+        content = data.get('content', '').strip()
+        if not content:
+            return fields, None
+        try:
+            with timed('decode'):
+                file_content = base64.b64decode(content)
+        except:
+            raise UploadError('Invalid file encoding')
+        with timed('write'):
+            return fields, stage_blob(file_content)
+    
+    if blob is not None and blob.size_bytes == 0:
+        blob.discard()
+        blob = None
+    return fields, blob
+
+ARCHIVE_MIMETYPES = {
+    'application/x-tar': 'tar',
+    'application/x-gtar': 'tar',
+    'application/gzip': 'tar',
+    'application/x-gzip': 'tar',
+    'application/zip': 'zip',
+    'application/x-zip-compressed': 'zip',
+}
+
+def _discard_staged(files):
+    for _, blob in files:
+        if blob is not None:
+            blob.discard()
+
+def _read_tar_upload(stream):
+    """Stage the .py members of a (possibly compressed) tar, read as a stream"""
+    import tarfile
+    files = []
+    try:
+        with tarfile.open(fileobj=stream, mode='r|*') as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                if len(files) >= BATCH_MAX_FILES:
+                    raise UploadError(f'At most {BATCH_MAX_FILES} files per batch')
+                name = os.path.basename(member.name)
+                # Other members are listed as skipped without being written
+                blob = stage_blob_stream(archive.extractfile(member)) if name.endswith('.py') else None
+                files.append((name, blob))
+    except tarfile.TarError as e:
+        _discard_staged(files)
+        raise UploadError(f'Invalid tar archive: {e}')
+    except BaseException:
+        _discard_staged(files)
+        raise
+    return files
+
+def _read_zip_upload(stream):
+    """Stage the .py members of a zip; the body is spooled to disk first
+    
+    The zip directory is at the end of the archive, so it can't be read as
+    a stream the way a tar can.
+    """
+    files = []
+    # May be the first request this process serves, before anything else has created BLOB_TMP_FOLDER
+    init_storage()
+    with tempfile.TemporaryFile(dir=BLOB_TMP_FOLDER) as spool:
+        shutil.copyfileobj(stream, spool, UPLOAD_CHUNK_SIZE)
+        try:
+            with zipfile.ZipFile(spool) as archive:
+                for member in archive.infolist():
+                    if member.is_dir():
+                        continue
+                    if len(files) >= BATCH_MAX_FILES:
+                        raise UploadError(f'At most {BATCH_MAX_FILES} files per batch')
+                    name = os.path.basename(member.filename)
+                    blob = None
+                    if name.endswith('.py'):
+                        with archive.open(member) as f:
+                            blob = stage_blob_stream(f)
+                    files.append((name, blob))
+        except (zipfile.BadZipFile, zipfile.LargeZipFile) as e:
+            _discard_staged(files)
+            raise UploadError(f'Invalid zip archive: {e}')
+        except BaseException:
+            _discard_staged(files)
+            raise
+    return files
+
+def read_batch_upload_request():
+    """Read shared fields and stage every file of a batch upload
+    
+    Accepts multipart/form-data with many 'file'/'files' parts, a JSON body
+    {"files": [{"filename", "content" (base64)}, ...]}, or a tar/zip archive
+    body (fields then come from the query string, as for octet-stream
+    uploads). Returns (fields, [(filename, StagedBlob or None)]); the caller
+    owns the blobs and must discard() them.
+    """
+    mimetype = request.mimetype
+    
+    if mimetype == 'multipart/form-data':
+        with timed('stream'):
+            return parse_multipart_upload(request.stream, request.headers.get('Content-Type', ''),
+                                          max_files=BATCH_MAX_FILES)
+    
+    if mimetype in ARCHIVE_MIMETYPES:
+        fields = request.args.to_dict()
+        if request.headers.get('X-Paste-Password'):
+            fields['password'] = request.headers['X-Paste-Password']
+        with timed('stream'):
+            if ARCHIVE_MIMETYPES[mimetype] == 'zip':
+                return fields, _read_zip_upload(request.stream)
+            return fields, _read_tar_upload(request.stream)
+    
+    with timed('json'):
+        data = request.get_json()
+    if not isinstance(data, dict) or not isinstance(data.get('files'), list):
+        raise UploadError('No files provided')
+    if len(data['files']) > BATCH_MAX_FILES:
+        raise UploadError(f'At most {BATCH_MAX_FILES} files per batch')
+    fields = {
+        'password': data.get('password', ''),
+        'is_private': data.get('is_private', False),
+        'ttl': data.get('ttl', ''),
+    }
+    files = []
+    try:
+        for entry in data['files']:
+            if not isinstance(entry, dict):
+                raise UploadError('Each entry in files must be an object with filename and content')
+            content = str(entry.get('content', '')).strip()
+            try:
+                with timed('decode'):
+                    file_content = base64.b64decode(content)
+            except Exception:
+                raise UploadError(f"Invalid file encoding: {entry.get('filename', '')}")
+            with timed('write'):
+                blob = stage_blob(file_content) if file_content else None
+            files.append((str(entry.get('filename', '')), blob))
+    except BaseException:
+        _discard_staged(files)
+        raise
+    return fields, files
+
+# Version history and patch updates
+PATCH_MIMETYPES = ('text/x-diff', 'text/x-patch')
+DELTA_EDIT = struct.Struct('>QQQ')  # offset, length, replacement size; the replacement follows
+
+class PatchError(UploadError):
+    pass
+
+class VersionConflict(Exception):
+    """The paste changed since the version an update was based on"""
+    
+    def __init__(self, current_info):
+        super().__init__('base_hash does not match the current version')
+        self.current_info = current_info
+
+def read_patch_request():
+    """Read a patch-style update, if the request is one
+    
+    A unified diff is sent as text/x-diff (or text/x-patch) with the fields
+    in the query string, or as 'diff' in a JSON body; byte-range edits as
+    'edits' in a JSON body, each {offset, length, content (base64)} against
+    the base version. Returns (fields, patch) where patch is ('diff', bytes)
+    or ('edits', [(offset, length, bytes)]), or (None, None) for any other
+    request, whose body is left unread.
+    """
+    if request.mimetype in PATCH_MIMETYPES:
+        fields = request.args.to_dict()
+        if request.headers.get('X-Paste-Password'):
+            fields['password'] = request.headers['X-Paste-Password']
+        with timed('stream'):
+            return fields, ('diff', request.get_data())
+    
+    if not request.is_json:
+        return None, None
+    with timed('json'):
+        data = request.get_json(silent=True)
+    if not isinstance(data, dict) or ('diff' not in data and 'edits' not in data):
+        return None, None
+    fields = {
+        'filename': data.get('filename', ''),
+        'password': data.get('password', ''),
+        'base_hash': data.get('base_hash', ''),
+    }
+    if 'diff' in data:
+        if not isinstance(data['diff'], str):
+            raise PatchError('diff must be a string')
+        return fields, ('diff', data['diff'].encode('utf-8'))
+    
+    if not isinstance(data['edits'], list):
+        raise PatchError('edits must be a list')
+    edits = []
+    for edit in data['edits']:
+        try:
+            offset, length = int(edit['offset']), int(edit.get('length', 0))
+            content = base64.b64decode(edit.get('content', ''), validate=True)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise PatchError('Each edit needs an integer offset and length and base64 content')
+        if offset < 0 or length < 0:
+            raise PatchError('Edit offsets and lengths must not be negative')
+        edits.append((offset, length, content))
+    return fields, ('edits', sorted(edits, key=lambda edit: edit[0]))
+
+def apply_edits(content, edits):
+    """Apply (offset, length, replacement) edits, sorted and non-overlapping, to content"""
+    parts = []
+    position = 0
+    for offset, length, replacement in edits:
+        if offset < position or offset + length > len(content):
+            raise PatchError('Edits must not overlap and must lie inside the base version')
+        parts.append(content[position:offset])
+        parts.append(replacement)
+        position = offset + length
+    parts.append(content[position:])
+    return b''.join(parts)
+
+def apply_unified_diff(content, diff):
+    """Apply a single-file unified diff to content; context and removed lines must match"""
+    import re
+    hunk_header = re.compile(rb'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+    lines = content.splitlines(keepends=True)
+    diff_lines = diff.splitlines(keepends=True)
+    out = []
+    position = 0
+    i = 0
+    hunks = 0
+    while i < len(diff_lines):
+        match = hunk_header.match(diff_lines[i])
+        i += 1
+        if not match:
+            # ---/+++ headers, git's diff/index lines and anything between files
+            continue
+        hunks += 1
+        old_start, old_count, _, new_count = (int(n) if n is not None else 1 for n in match.groups())
+        # A hunk that removes nothing names the line it inserts after
+        start = old_start - 1 if old_count else old_start
+        if start < position or start > len(lines):
+            raise PatchError(f'Hunk {hunks} is out of order or outside the base version')
+        out.extend(lines[position:start])
+        position = start
+        
+        old_seen = new_seen = 0
+        while old_seen < old_count or new_seen < new_count:
+            if i >= len(diff_lines):
+                raise PatchError(f'Hunk {hunks} is truncated')
+            line = diff_lines[i]
+            i += 1
+            tag, text = line[:1], line[1:]
+            if tag in (b'\n', b'\r'):
+                # Some tools drop the space in front of an empty context line
+                tag, text = b' ', line
+            if i < len(diff_lines) and diff_lines[i].startswith(b'\\'):
+                # "\ No newline at end of file" applies to the line before it
+                text = text.rstrip(b'\r\n')
+                i += 1
+            
+            if tag in (b' ', b'-'):
+                if position >= len(lines) or lines[position] != text:
+                    raise PatchError(f'Hunk {hunks} does not apply at line {position + 1}')
+                position += 1
+                old_seen += 1
+            if tag in (b' ', b'+'):
+                out.append(text)
+                new_seen += 1
+            if tag not in (b' ', b'-', b'+'):
+                raise PatchError(f'Unexpected line in hunk {hunks}: {line[:40]!r}')
+    
+    if not hunks:
+        raise PatchError('The diff has no hunks')
+    out.extend(lines[position:])
+    return b''.join(out)
+
+def apply_patch(content, patch):
+    kind, body = patch
+    return apply_unified_diff(content, body) if kind == 'diff' else apply_edits(content, body)
+
+def _common_prefix(a, b, block=64 * 1024):
+    limit = min(len(a), len(b))
+    position = 0
+    # Whole blocks compare at memcmp speed; only the first differing one is scanned
+    while position < limit and a[position:position + block] == b[position:position + block]:
+        position += block
+    position = min(position, limit)
+    end = min(position + block, limit)
+    while position < end and a[position] == b[position]:
+        position += 1
+    return position
+
+def make_delta(new, old):
+    """Edits (offset, length, replacement) that turn new into old
+    
+    The common prefix and suffix are trimmed first, so a single edit costs
+    time in proportion to the file only for those comparisons; what remains
+    is diffed line by line unless it is large.
+    """
+    import difflib
+    prefix = _common_prefix(new, old)
+    limit = min(len(new), len(old)) - prefix
+    suffix = min(_common_prefix(new[::-1], old[::-1]), limit)
+    new_middle = new[prefix:len(new) - suffix]
+    old_middle = old[prefix:len(old) - suffix]
+    if not new_middle and not old_middle:
+        return []
+    if len(new_middle) + len(old_middle) > VERSION_DIFF_MAX_BYTES:
+        return [(prefix, len(new_middle), old_middle)]
+    
+    new_lines = new_middle.splitlines(keepends=True)
+    old_lines = old_middle.splitlines(keepends=True)
+    offsets = [prefix]
+    for line in new_lines:
+        offsets.append(offsets[-1] + len(line))
+    edits = []
+    matcher = difflib.SequenceMatcher(None, new_lines, old_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != 'equal':
+            edits.append((offsets[i1], offsets[i2] - offsets[i1], b''.join(old_lines[j1:j2])))
+    return edits
+
+def encode_delta(edits):
+    import zlib
+    return zlib.compress(b''.join(DELTA_EDIT.pack(offset, length, len(replacement)) + replacement
+                                  for offset, length, replacement in edits))
+
+def decode_delta(data):
+    import zlib
+    raw = zlib.decompress(data)
+    edits = []
+    position = 0
+    while position < len(raw):
+        offset, length, size = DELTA_EDIT.unpack_from(raw, position)
+        position += DELTA_EDIT.size
+        edits.append((offset, length, raw[position:position + size]))
+        position += size
+    return edits
+
+def read_content(file_info):
+    """The stored content of a metadata entry, uncompressed"""
+    with open_blob(content_path(file_info), file_info.get('encoding', 'identity')) as f:
+        return f.read()
+
+def read_staged_blob(blob):
+    if blob.content is not None:
+        return blob.content
+    if blob.temp_path:
+        with open_blob(blob.temp_path, blob.encoding) as f:
+            return f.read()
+    encoding = _stored_encoding(blob.hash)
+    with open_blob(blob_path(blob.hash, encoding), encoding) as f:
+        return f.read()
+
+def version_delta(old_info, blob, old_content=None, new_content=None):
+    """Encoded reverse delta rebuilding old_info's content from blob's, or None to keep a full copy"""
+    if (not VERSION_MAX_HISTORY or not old_info.get('blob_hash') or old_info['blob_hash'] == blob.hash
+            or max(old_info['size_bytes'], blob.size_bytes) > VERSION_DELTA_MAX_BYTES):
+        return None
+    try:
+        if old_content is None:
+            old_content = read_content(old_info)
+        if new_content is None:
+            new_content = read_staged_blob(blob)
+    except OSError:
+        return None
+    delta = encode_delta(make_delta(new_content, old_content))
+    return delta if len(delta) < old_info['size_bytes'] else None
+
+def _archive_version(conn, file_id, old_info, version, delta):
+    """Move the outgoing current version into the versions table"""
+    if delta is not None:
+        # Delta rows above the newest full copy: each rebuild below it applies all of them
+        chain = conn.execute(
+            'SELECT COUNT(*) FROM versions WHERE file_id = ? AND version > '
+            '(SELECT COALESCE(MAX(version), 0) FROM versions WHERE file_id = ? AND blob_hash IS NOT NULL)',
+            (file_id, file_id)
+        ).fetchone()[0]
+        if chain >= VERSION_CHECKPOINT_INTERVAL:
+            delta = None
+    if delta is None:
+        # Outlives the release of the old content when the new version is written
+        _retain_blob(conn, old_info['blob_hash'])
+    conn.execute(
+        'INSERT OR REPLACE INTO versions (file_id, version, content_hash, size_bytes, original_name, '
+        'created_at, blob_hash, delta) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (file_id, version, old_info['blob_hash'], old_info['size_bytes'], old_info['original_name'],
+         old_info['upload_time'], old_info['blob_hash'] if delta is None else None, delta)
+    )
+    
+    # Nothing is rebuilt from the oldest versions, so they can simply go
+    oldest_kept = version - VERSION_MAX_HISTORY + 1
+    for (blob_hash,) in conn.execute(
+        'SELECT blob_hash FROM versions WHERE file_id = ? AND version < ? AND blob_hash IS NOT NULL',
+        (file_id, oldest_kept)
+    ).fetchall():
+        _release_blob(conn, blob_hash)
+    conn.execute('DELETE FROM versions WHERE file_id = ? AND version < ?', (file_id, oldest_kept))
+
+def _write_version(conn, file_id, file_info, blob, base_hash, delta):
+    row = conn.execute('SELECT info FROM files WHERE file_id = ?', (file_id,)).fetchone()
+    old_info = json.loads(row[0]) if row else None
+    if old_info is None or old_info.get('blob_hash') != base_hash:
+        raise VersionConflict(old_info)
+    
+    version = old_info.get('version', 1)
+    if blob.hash != base_hash:
+        version += 1
+        # Pastes stored before content addressing start their history here
+        if VERSION_MAX_HISTORY and base_hash:
+            _archive_version(conn, file_id, old_info, version - 1, delta)
+    file_info['version'] = version
+    _write_file_info(conn, file_id, file_info, blob=blob)
+
+def save_file_version(file_id, file_info, blob, base_hash, delta):
+    """Replace a paste's content, archiving the outgoing version with delta
+    
+    Raises VersionConflict if the current content's hash is no longer
+    base_hash (or the paste is gone), since delta was computed against it.
+    """
+    write_transaction(lambda conn: _write_version(conn, file_id, file_info, blob, base_hash, delta))
+
+def load_versions(file_id):
+    """The archived versions of a paste, newest first"""
+    rows = get_db().execute(
+        'SELECT version, content_hash, size_bytes, original_name, created_at, blob_hash, LENGTH(delta) '
+        'FROM versions WHERE file_id = ? ORDER BY version DESC', (file_id,)
+    ).fetchall()
+    return [{
+        'version': version,
+        'content_hash': content_hash,
+        'size_bytes': size_bytes,
+        'filename': original_name,
+        'created_at': created_at,
+        'stored_as': 'full' if blob_hash else 'delta',
+        'stored_bytes': 0 if blob_hash else delta_bytes
+    } for version, content_hash, size_bytes, original_name, created_at, blob_hash, delta_bytes in rows]
+
+def _load_version_chain(file_id, version):
+    """The current metadata and the versions rows from version up to the next full copy, in one snapshot"""
+    conn = get_db()
+    conn.execute('BEGIN')
+    try:
+        row = conn.execute('SELECT info FROM files WHERE file_id = ?', (file_id,)).fetchone()
+        rows = conn.execute(
+            'SELECT version, content_hash, size_bytes, original_name, created_at, blob_hash, delta '
+            'FROM versions WHERE file_id = ? AND version >= ? ORDER BY version LIMIT ?',
+            (file_id, version, VERSION_CHECKPOINT_INTERVAL + 1)
+        ).fetchall()
+    finally:
+        conn.execute('COMMIT')
+    if row is None or not rows or rows[0][0] != version:
+        return None, []
+    return json.loads(row[0]), rows
+
+def _rebuild_version(current_info, rows):
+    """Content of rows[0]'s version: the nearest newer full copy with the deltas down to it applied"""
+    deltas = []
+    for version, _, _, _, _, blob_hash, delta in rows:
+        if blob_hash:
+            encoding = _stored_encoding(blob_hash)
+            with open_blob(blob_path(blob_hash, encoding), encoding) as f:
+                content = f.read()
+            break
+        deltas.append(delta)
+    else:
+        if rows[-1][0] + 1 != current_info.get('version', 1):
+            raise ValueError('Version chain does not reach the current version')
+        content = read_content(current_info)
+    for delta in reversed(deltas):
+        content = apply_edits(content, decode_delta(delta))
+    return content
+
+def version_file(file_id, version):
+    """(metadata, path) of an archived version, rebuilt on first use; None if it isn't kept
+    
+    The metadata looks like a paste's own, with blob_hash set to the
+    version's content hash (so execution results are cached per content).
+    Rebuilt versions are written to VERSION_CACHE_FOLDER by content hash.
+    """
+    import zlib
+    for _ in range(3):
+        current_info, rows = _load_version_chain(file_id, version)
+        if current_info is None:
+            return None
+        _, content_hash, size_bytes, original_name, created_at, _, _ = rows[0]
+        version_info = {
+            'original_name': original_name,
+            'blob_hash': content_hash,
+            'upload_time': created_at,
+            'is_private': current_info['is_private'],
+            'has_password': current_info['has_password'],
+            'size_bytes': size_bytes,
+            'version': version
+        }
+        path = os.path.join(VERSION_CACHE_FOLDER, f'{content_hash}.py')
+        try:
+            # Refreshes the mtime the sweeper prunes by
+            os.utime(path)
+            return version_info, path
+        except FileNotFoundError:
+            pass
+        
+        try:
+            content = _rebuild_version(current_info, rows)
+        except (OSError, ValueError, zlib.error, struct.error):
+            # A concurrent update released the copy the snapshot pointed at
+            continue
+        if hashlib.sha256(content).hexdigest() != content_hash:
+            continue
+        os.makedirs(VERSION_CACHE_FOLDER, exist_ok=True)
+        temp_path = _new_temp_path()
+        with open(temp_path, 'wb') as f:
+            f.write(content)
+        os.replace(temp_path, path)
+        return version_info, path
+    raise RuntimeError(f'Version {version} could not be rebuilt')
+
+def prune_version_cache():
+    """Remove rebuilt versions unused for VERSION_CACHE_TTL seconds"""
+    cutoff = time.time() - VERSION_CACHE_TTL
+    try:
+        entries = list(os.scandir(VERSION_CACHE_FOLDER))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+def requested_version(file_info):
+    """The ?version= asked for, or None for the current one; raises ValueError if it isn't a number"""
+    value = request.args.get('version', '').strip()
+    if not value:
+        return None
+    version = int(value)
+    return None if version == file_info.get('version', 1) else version
+
+def hash_password(password):
+    return hashlib.sha256(password.encode()).hexdigest()
+
+def generate_file_id():
+    return str(uuid.uuid4())[:8]
+
+def sanitize_filename(filename):
+    """Sanitize filename to prevent path traversal"""
+    import re
+    filename = os.path.basename(filename)
+    filename = re.sub(r'[^\w\.\-]', '_', filename)
+    return filename[:100]
+
+# Metrics (per-process, Prometheus text exposition format)
+class Metrics:
+    """Minimal labelled counters and histograms"""
+    
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {}
+        self._counters = {}
+        self._histograms = {}
+    
+    def describe(self, name, kind, help_text):
+        self._types[name] = (kind, help_text)
+    
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+    
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = {'buckets': [0] * len(self.DEFAULT_BUCKETS), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.DEFAULT_BUCKETS):
+                if value <= bound:
+                    hist['buckets'][i] += 1
+            hist['sum'] += value
+            hist['count'] += 1
+    
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+    
+    def render(self, gauges=()):
+        """Render all series; gauges is an iterable of (name, labels dict, value)"""
+        samples = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                samples.setdefault(name, []).append(f"{name}{self._labels(labels)} {value}")
+            for (name, labels), hist in self._histograms.items():
+                lines = samples.setdefault(name, [])
+                for bound, count in zip(self.DEFAULT_BUCKETS, hist['buckets']):
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {hist['count']}")
+                lines.append(f"{name}_sum{self._labels(labels)} {hist['sum']}")
+                lines.append(f"{name}_count{self._labels(labels)} {hist['count']}")
+        for name, labels, value in gauges:
+            samples.setdefault(name, []).append(f"{name}{self._labels(sorted(labels.items()))} {value}")
+        
+        out = []
+        for name in sorted(samples):
+            kind, help_text = self._types.get(name, ('untyped', ''))
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(samples[name])
+        return '\n'.join(out) + '\n'
+
+metrics = Metrics()
+metrics.describe('pastebin_http_requests_total', 'counter', 'HTTP requests by route, method and status')
+metrics.describe('pastebin_http_request_duration_seconds', 'histogram', 'Time to produce a response, by route')
+metrics.describe('pastebin_execution_duration_seconds', 'histogram', 'Wall time of script executions')
+metrics.describe('pastebin_execution_timeouts_total', 'counter', 'Executions killed by the timeout')
+metrics.describe('pastebin_execution_cpu_seconds', 'histogram', 'CPU time (user + system) of script executions')
+metrics.describe('pastebin_rate_limited_total', 'counter', 'Requests refused by a rate limit, by route group and scope')
+metrics.describe('pastebin_load_shed_total', 'counter', 'Executions refused because too many were waiting')
+metrics.describe('pastebin_execution_slots', 'gauge', 'Executions waiting for and holding a slot')
+metrics.describe('pastebin_files', 'gauge', 'Stored pastes by visibility')
+metrics.describe('pastebin_stored_bytes', 'gauge', 'Paste bytes (logical) and unique blob bytes on disk')
+metrics.describe('pastebin_cache_hits_total', 'counter', 'Cache hits by cache')
+metrics.describe('pastebin_cache_misses_total', 'counter', 'Cache misses by cache')
+
+# Per-request phase timings, reported in Server-Timing and the request log
+logger = logging.getLogger('pastebin')
+if REQUEST_LOG and not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_log_handler)
+    logger.setLevel(logging.INFO)
+
+@contextmanager
+def timed(phase):
+    """Accumulate the time spent in a block under phase for the current request"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        # Background jobs run outside any request and are not attributed
+        if has_app_context():
+            timings = g.setdefault('timings', {})
+            timings[phase] = timings.get(phase, 0.0) + time.perf_counter() - started
+
+def storage_gauges():
+    counters = get_counters()
+    yield 'pastebin_files', {'visibility': 'public'}, counters['public_files']
+    yield 'pastebin_files', {'visibility': 'private'}, counters['private_files']
+    yield 'pastebin_stored_bytes', {'kind': 'logical'}, counters['bytes_stored']
+    yield 'pastebin_stored_bytes', {'kind': 'blob'}, counters['blob_bytes']
+    for cache_name, cache in (('metadata', metadata_cache), ('execution', execution_cache)):
+        stats = cache.stats()
+        yield 'pastebin_cache_hits_total', {'cache': cache_name}, stats['hits']
+        yield 'pastebin_cache_misses_total', {'cache': cache_name}, stats['misses']
+    backlog = execution_backlog.stats()
+    yield 'pastebin_execution_slots', {'state': 'waiting'}, backlog['waiting']
+    yield 'pastebin_execution_slots', {'state': 'running'}, backlog['running']
+
+# Code execution
+INTERPRETER_VERSION = f"{sys.implementation.cache_tag} {sys.version}"
+
+# Runs a source or .pyc file as __main__; shared by pool workers and one-off runs
+RUN_MAIN_SOURCE = r'''
+import builtins, json, linecache, marshal, os, sys, types, traceback
+
+def apply_limits(limits):
+    """Lower this process's rlimits (see EXEC_LIMITS) before the script runs
+    
+    Hard limits are lowered too, so the script can't raise them back. The
+    CPU hard limit is a second above the soft one: SIGXCPU first, then SIGKILL.
+    """
+    limits = dict(limits)
+    cgroup, max_pids = limits.pop('cgroup', ''), limits.pop('pids', 0)
+    if cgroup and max_pids > 0:
+        join_run_cgroup(cgroup, max_pids)
+    try:
+        import resource
+    except ImportError:
+        return
+    for name, value in limits.items():
+        if value <= 0:
+            continue
+        which = getattr(resource, 'RLIMIT_' + name.upper())
+        hard = value + 1 if name == 'cpu' else value
+        current_hard = resource.getrlimit(which)[1]
+        if current_hard != resource.RLIM_INFINITY:
+            value, hard = min(value, current_hard), min(hard, current_hard)
+        try:
+            resource.setrlimit(which, (value, hard))
+        except (ValueError, OSError):
+            pass
+
+def join_run_cgroup(parent, max_pids):
+    """Move this process into a cgroup of its own under parent, capped at max_pids tasks
+    
+    Whoever reaps the run removes it again (remove_run_cgroup()).
+    """
+    path = os.path.join(parent, f'run-{os.getpid()}')
+    try:
+        os.mkdir(path)
+        with open(os.path.join(path, 'pids.max'), 'w') as f:
+            f.write(str(max_pids))
+        with open(os.path.join(path, 'cgroup.procs'), 'w') as f:
+            f.write(str(os.getpid()))
+    except OSError:
+        pass
+
+def cache_compressed_source(filename):
+    """Let tracebacks show source lines of a blob stored as filename.gz"""
+    if os.path.exists(filename) or not os.path.exists(filename + '.gz'):
+        return
+    import gzip
+    with gzip.open(filename + '.gz', 'rb') as f:
+        source = f.read()
+    lines = source.decode('utf-8', 'replace').splitlines(True)
+    # No mtime, so linecache.checkcache() keeps the entry
+    linecache.cache[filename] = (len(source), None, lines, filename)
+
+def run_main(path):
+    """Execute path as __main__, the way `python path` would"""
+    # A gzip blob without bytecode runs under its uncompressed name
+    source_path = path[:-3] if path.endswith('.gz') else path
+    main = types.ModuleType('__main__')
+    main.__file__ = source_path
+    main.__builtins__ = builtins
+    sys.modules['__main__'] = main
+    sys.argv = [source_path]
+    sys.path[0] = os.path.dirname(os.path.abspath(path))
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        if path.endswith('.pyc'):
+            code = marshal.loads(data[16:])  # Skip the pyc header
+            cache_compressed_source(code.co_filename)
+        elif path.endswith('.gz'):
+            import gzip
+            cache_compressed_source(source_path)
+            code = compile(gzip.decompress(data), source_path, 'exec')
+        else:
+            code = compile(data, path, 'exec')
+        exec(code, main.__dict__)
+        return 0
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        if isinstance(e.code, int):
+            return e.code
+        print(e.code, file=sys.stderr)
+        return 1
+    except BaseException as e:
+        # Drop this frame so the traceback starts at the user's code
+        traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+        return 1
+'''
+
+# argv: path, limits JSON, and an fd to report the interpreter's peak RSS on.
+# The exec'ing process's ru_maxrss starts at the server's own high-water mark
+# (Linux carries it across exec), so a fresh run reports its VmHWM instead.
+RUN_FILE_SOURCE = RUN_MAIN_SOURCE + '''
+def report_peak_rss(fd):
+    try:
+        import resource
+        with open('/proc/self/status') as f:
+            peak_kb = next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+        peak_kb = max(peak_kb, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        os.write(fd, str(peak_kb).encode())
+    except (ImportError, OSError, ValueError, StopIteration):
+        pass
+
+def on_cpu_limit(signum, frame):
+    # Report before dying of the signal, so the exit status still says why
+    report_peak_rss(peak_fd)
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+import signal
+path, limits, peak_fd = sys.argv[1], json.loads(sys.argv[2]), int(sys.argv[3])
+if hasattr(signal, 'SIGXCPU'):
+    signal.signal(signal.SIGXCPU, on_cpu_limit)
+apply_limits(limits)
+code = run_main(path)
+report_peak_rss(peak_fd)
+sys.exit(code)
+'''
+
+def run_file_args(file_path, peak_fd, unbuffered=False):
+    """Command line for running a stored file in a fresh interpreter under EXEC_LIMITS"""
+    # -u so the script's output isn't held back in its own stdio buffers
+    return ([PYTHON_EXECUTABLE] + (['-u'] if unbuffered else [])
+            + ['-c', RUN_FILE_SOURCE, file_path, json.dumps(EXEC_LIMITS), str(peak_fd)])
+
+def spawn_run(file_path, unbuffered=False):
+    """Start a fresh-interpreter run; returns (proc, fd for read_peak_rss() once it is reaped)"""
+    import subprocess
+    peak_r, peak_w = os.pipe()
+    try:
+        proc = subprocess.Popen(run_file_args(file_path, peak_w, unbuffered), stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                pass_fds=(peak_w,), start_new_session=True)
+    except BaseException:
+        os.close(peak_r)
+        raise
+    finally:
+        os.close(peak_w)
+    return proc, peak_r
+
+def remove_run_cgroup(pid):
+    """remove_run_cgroup() of POOL_WORKER_SOURCE, for fresh runs once they are reaped"""
+    import signal
+    if not EXEC_LIMITS['pids']:
+        return
+    path = os.path.join(EXEC_CGROUP, f'run-{pid}')
+    try:
+        with open(os.path.join(path, 'cgroup.procs')) as f:
+            for task in f.read().split():
+                try:
+                    os.kill(int(task), signal.SIGKILL)
+                except OSError:
+                    pass
+        os.rmdir(path)
+    except OSError:
+        pass  # Gone already, or still busy: prune_run_cgroups() retries
+
+def prune_run_cgroups():
+    """Remove run cgroups whose removal after the run failed (busy with dying tasks)"""
+    if not EXEC_LIMITS['pids']:
+        return
+    cutoff = time.time() - 2 * EXEC_TIMEOUT
+    try:
+        entries = [entry for entry in os.scandir(EXEC_CGROUP) if entry.name.startswith('run-')]
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.rmdir(entry.path)
+        except OSError:
+            pass
+
+def proc_peak_rss(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            return next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+    except (OSError, ValueError, StopIteration):
+        return None
+
+def read_peak_rss(proc, peak_fd):
+    """The peak RSS (kB) a reaped run reported, or what kill_run() saw; None if neither"""
+    try:
+        data = os.read(peak_fd, 32)
+    finally:
+        os.close(peak_fd)
+    return int(data) if data.isdigit() else getattr(proc, 'peak_rss_kb', None)
+
+def resource_usage(rusage, wall_seconds, peak_rss_kb=None):
+    return {
+        'cpu_seconds': round(rusage.ru_utime + rusage.ru_stime, 4),
+        # ru_maxrss is in kilobytes on Linux; for killed fresh runs it's an upper bound
+        'peak_rss_kb': peak_rss_kb or rusage.ru_maxrss,
+        'wall_seconds': round(wall_seconds, 4)
+    }
+
+def wait_with_rusage(proc, timeout=None):
+    """Popen.wait() that also returns the child's rusage (from wait4)
+    
+    Sets proc.returncode; raises subprocess.TimeoutExpired like wait(). Waits
+    on a pidfd where the kernel has them, otherwise polls.
+    """
+    import select
+    import subprocess
+    if timeout is None:
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        return rusage
+    
+    deadline = time.monotonic() + timeout
+    try:
+        pidfd = os.pidfd_open(proc.pid)
+    except (AttributeError, OSError):
+        pidfd = None
+    try:
+        while True:
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                proc.returncode = os.waitstatus_to_exitcode(status)
+                return rusage
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(proc.args, timeout)
+            if pidfd is not None:
+                select.select([pidfd], [], [], remaining)
+            else:
+                time.sleep(min(remaining, 0.005))
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
+
+def kill_run(proc):
+    """Kill a run started with start_new_session=True, with anything it forked"""
+    import signal
+    if proc.returncode is None:
+        # A killed run can't report its own peak, so take it now
+        proc.peak_rss_kb = proc_peak_rss(proc.pid)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+def execution_status(returncode, usage=None):
+    import signal
+    if returncode == 0:
+        return 'Success'
+    cpu_seconds = (usage or {}).get('cpu_seconds', 0)
+    if EXEC_CPU_LIMIT and (returncode == -signal.SIGXCPU
+                           or (returncode == -signal.SIGKILL and cpu_seconds >= EXEC_CPU_LIMIT)):
+        return f'Killed (CPU limit of {EXEC_CPU_LIMIT} seconds exceeded)'
+    return f'Failed (Code: {returncode})'
+
+def format_usage(usage):
+    return (f"CPU {usage['cpu_seconds']:.3f}s, peak memory {usage['peak_rss_kb'] / 1024:.1f} MiB, "
+            f"wall {usage['wall_seconds']:.3f}s")
+
+# Warm interpreter pool
+#
+# Each pool worker is a long-lived interpreter that has already paid for
+# startup, site and the EXEC_POOL_PRELOAD imports. It reads one JSON job per
+# line on stdin, forks a child per job (so runs never see each other's state),
+# enforces the timeout on that child and answers with one JSON line.
+POOL_WORKER_SOURCE = RUN_MAIN_SOURCE + r'''
+import json, select, signal, tempfile, time
+
+for name in sys.argv[1].split(','):
+    if name:
+        try:
+            __import__(name)
+        except Exception:
+            pass
+
+control_in = os.fdopen(os.dup(0), 'rb')
+control_out = os.fdopen(os.dup(1), 'wb')
+devnull = os.open(os.devnull, os.O_RDWR)
+os.dup2(devnull, 0)
+os.dup2(devnull, 1)
+
+def remove_run_cgroup(limits, pid):
+    """Kill whatever escaped the run's session inside its cgroup, then remove the cgroup"""
+    if not limits.get('cgroup') or limits.get('pids', 0) <= 0:
+        return
+    path = os.path.join(limits['cgroup'], f'run-{pid}')
+    try:
+        with open(os.path.join(path, 'cgroup.procs')) as f:
+            for task in f.read().split():
+                try:
+                    os.kill(int(task), signal.SIGKILL)
+                except OSError:
+                    pass
+        os.rmdir(path)
+    except OSError:
+        pass  # Gone already, or still busy: the server's prune_run_cgroups() retries
+
+def child(job, out, err, ready_w):
+    code = 1
+    try:
+        os.setsid()
+        os.dup2(devnull, 0)
+        os.dup2(out.fileno(), 1)
+        os.dup2(err.fileno(), 2)
+        control_in.close()
+        control_out.close()
+        apply_limits(job['limits'])
+        code = run_main(job['path'])
+        try:
+            import atexit
+            atexit._run_exitfuncs()
+        except BaseException:
+            pass
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code & 0xff)
+
+def run_job(job):
+    out = tempfile.TemporaryFile()
+    err = tempfile.TemporaryFile()
+    # The child holds the write end; EOF on ready_r means it has exited
+    ready_r, ready_w = os.pipe()
+    started = time.monotonic()
+    pid = os.fork()
+    if pid == 0:
+        os.close(ready_r)
+        child(job, out, err, ready_w)
+    os.close(ready_w)
+    
+    timed_out = not select.select([ready_r], [], [], job['timeout'])[0]
+    os.close(ready_r)
+    if timed_out:
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass
+    _, status, rusage = os.wait4(pid, 0)
+    remove_run_cgroup(job['limits'], pid)
+    
+    result = {
+        'timed_out': timed_out,
+        'returncode': os.waitstatus_to_exitcode(status),
+        # ru_maxrss is in kilobytes on Linux
+        'usage': {'cpu_seconds': round(rusage.ru_utime + rusage.ru_stime, 4), 'peak_rss_kb': rusage.ru_maxrss,
+                  'wall_seconds': round(time.monotonic() - started, 4)}
+    }
+    for name, f in (('stdout', out), ('stderr', err)):
+        f.seek(0)
+        result[name] = f.read().decode('utf-8', 'replace')
+        f.close()
+    return result
+
+for line in control_in:
+    result = run_job(json.loads(line))
+    control_out.write(json.dumps(result).encode() + b'\n')
+    control_out.flush()
+'''
+
+class PoolWorkerError(RuntimeError):
+    pass
+
+class PoolWorker:
+    def __init__(self):
+        import subprocess
+        self.proc = subprocess.Popen(
+            [PYTHON_EXECUTABLE, '-c', POOL_WORKER_SOURCE, EXEC_POOL_PRELOAD],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE
+        )
+        self.started = time.time()
+        self.jobs = 0
+    
+    def run(self, file_path, timeout):
+        self.jobs += 1
+        try:
+            job = {'path': file_path, 'timeout': timeout, 'limits': EXEC_LIMITS}
+            self.proc.stdin.write(json.dumps(job).encode() + b'\n')
+            self.proc.stdin.flush()
+            line = self.proc.stdout.readline()
+        except OSError as e:
+            raise PoolWorkerError(f'Pool worker failed: {e}')
+        if not line:
+            raise PoolWorkerError('Pool worker exited unexpectedly')
+        return json.loads(line)
+    
+    def alive(self):
+        return self.proc.poll() is None
+    
+    def stop(self):
+        if self.alive():
+            self.proc.kill()
+        self.proc.wait()
+
+class InterpreterPool:
+    """Fixed-size pool of warm PoolWorkers, started lazily and recycled after max_jobs"""
+    
+    def __init__(self, size, max_jobs):
+        self.size = size
+        self.max_jobs = max_jobs
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(size)
+        self._idle = []
+        self._busy = 0
+        self.started = 0
+        self.recycled = 0
+        self.failures = 0
+        self.jobs = 0
+    
+    def _spawn(self):
+        worker = PoolWorker()
+        with self._lock:
+            self.started += 1
+        return worker
+    
+    def _refill(self):
+        worker = self._spawn()
+        with self._lock:
+            self._idle.append(worker)
+    
+    def warm(self):
+        """Start every missing worker in the background"""
+        with self._lock:
+            missing = self.size - len(self._idle) - self._busy
+        for _ in range(missing):
+            threading.Thread(target=self._refill, daemon=True).start()
+    
+    def run(self, file_path, timeout):
+        with execution_backlog.slot(self._slots):
+            with self._lock:
+                worker = self._idle.pop() if self._idle else None
+                self._busy += 1
+            try:
+                if worker is None or not worker.alive():
+                    worker = self._spawn()
+                    self.warm()
+                try:
+                    result = worker.run(file_path, timeout)
+                except PoolWorkerError:
+                    worker.stop()
+                    worker = None
+                    with self._lock:
+                        self.failures += 1
+                    raise
+                
+                with self._lock:
+                    self.jobs += 1
+                    if worker.jobs >= self.max_jobs:
+                        self.recycled += 1
+                        recycle, worker = worker, None
+                    else:
+                        recycle = None
+                if recycle is not None:
+                    recycle.stop()
+                    threading.Thread(target=self._refill, daemon=True).start()
+                return result
+            finally:
+                with self._lock:
+                    self._busy -= 1
+                    if worker is not None:
+                        self._idle.append(worker)
+    
+    def status(self):
+        with self._lock:
+            return {
+                'enabled': True,
+                'size': self.size,
+                'max_jobs_per_worker': self.max_jobs,
+                'idle': len(self._idle),
+                'busy': self._busy,
+                'workers': [{'pid': w.proc.pid, 'jobs': w.jobs, 'uptime': round(time.time() - w.started, 1)}
+                            for w in self._idle],
+                'started': self.started,
+                'recycled': self.recycled,
+                'failures': self.failures,
+                'jobs': self.jobs
+            }
+
+interpreter_pool = InterpreterPool(EXEC_POOL_SIZE, EXEC_POOL_MAX_JOBS) \
+    if EXEC_POOL_SIZE > 0 and hasattr(os, 'fork') else None
+
+# Runs in a new interpreter (?stream= under WSGI, and run_python_file() without
+# a pool or after a pool worker died) are bounded separately from the pool
+fresh_run_slots = threading.Semaphore(EXEC_FRESH_CONCURRENCY)
+
+def run_python_file(file_path):
+    """Run a stored file; returns its stdout/stderr/returncode, timed_out and resource usage
+    
+    Uses the warm pool when enabled, falling back to a fresh interpreter if a
+    pool worker dies. Runs are killed after EXEC_TIMEOUT seconds.
+    """
+    if interpreter_pool is not None:
+        try:
+            return interpreter_pool.run(file_path, EXEC_TIMEOUT)
+        except PoolWorkerError:
+            pass
+    
+    with execution_backlog.slot(fresh_run_slots):
+        return run_fresh_interpreter(file_path)
+
+def run_fresh_interpreter(file_path):
+    """run_python_file() in a new interpreter; the caller holds one of fresh_run_slots"""
+    import subprocess
+    started = time.monotonic()
+    deadline = started + EXEC_TIMEOUT
+    proc, peak_fd = spawn_run(file_path)
+    # Output is read here rather than by communicate(), which would reap the
+    # process before wait4() could collect its rusage
+    output = {'stdout': [], 'stderr': []}
+    timed_out = False
+    try:
+        with selectors.DefaultSelector() as selector:
+            selector.register(proc.stdout, selectors.EVENT_READ, 'stdout')
+            selector.register(proc.stderr, selectors.EVENT_READ, 'stderr')
+            while selector.get_map() and not timed_out:
+                remaining = deadline - time.monotonic()
+                timed_out = remaining <= 0
+                for key, _ in selector.select(max(remaining, 0)):
+                    chunk = os.read(key.fd, 65536)
+                    if chunk:
+                        output[key.data].append(chunk)
+                    else:
+                        selector.unregister(key.fileobj)
+        try:
+            rusage = wait_with_rusage(proc, 0 if timed_out else max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            kill_run(proc)
+            rusage = wait_with_rusage(proc)
+    finally:
+        kill_run(proc)
+        if proc.returncode is None:
+            wait_with_rusage(proc)
+        proc.stdout.close()
+        proc.stderr.close()
+        peak_rss_kb = read_peak_rss(proc, peak_fd)
+        remove_run_cgroup(proc.pid)
+    
+    return {
+        'stdout': b''.join(output['stdout']).decode('utf-8', 'replace'),
+        'stderr': b''.join(output['stderr']).decode('utf-8', 'replace'),
+        'returncode': proc.returncode,
+        'timed_out': timed_out,
+        'usage': resource_usage(rusage, time.monotonic() - started, peak_rss_kb)
+    }
+
+def cached_execution_report(file_id, file_info, use_cache=False):
+    """The report for a run that needs no process, if there is one
+    
+    Returns (output or None, cache_status) where cache_status is HIT, MISS or BYPASS.
+    """
+    use_cache = use_cache and file_info.get('blob_hash') is not None
+    if use_cache:
+        entry = execution_cache.get(file_info['blob_hash'])
+        if entry is not None:
+            return format_execution_report(file_id, file_info, entry['result'],
+                                           cached_at=entry['executed_at']), 'HIT'
+    cache_status = 'MISS' if use_cache else 'BYPASS'
+    
+    if file_info.get('syntax_error'):
+        # Failed to compile at upload time: answer without starting a process
+        return format_execution_report(file_id, file_info, syntax_error_result(file_info)), cache_status
+    return None, cache_status
+
+def finish_execution_report(file_id, file_info, result, cache_status):
+    """Record a finished run and build its report (or the timeout message)"""
+    execution_stats.record(file_id, result['returncode'], result['timed_out'], result['usage'])
+    metrics.observe('pastebin_execution_cpu_seconds', result['usage']['cpu_seconds'], mode='run')
+    if result['timed_out']:
+        metrics.inc('pastebin_execution_timeouts_total', mode='run')
+        return f"Execution timed out ({EXEC_TIMEOUT} seconds)\nResources: {format_usage(result['usage'])}\n"
+    if cache_status == 'MISS':
+        execution_cache.put(file_info['blob_hash'], result)
+    return format_execution_report(file_id, file_info, result)
+
+def execute_and_report(file_id, file_info, file_path, use_cache=False):
+    """Run a file (or reuse a cached result) and build the plain-text report
+    
+    Returns (output, cache_status) where cache_status is HIT, MISS or BYPASS.
+    """
+    output, cache_status = cached_execution_report(file_id, file_info, use_cache)
+    if output is not None:
+        return output, cache_status
+    return run_and_report(file_id, file_info, file_path, cache_status), cache_status
+
+def run_and_report(file_id, file_info, file_path, cache_status):
+    """Run a file that needs a process and build its report"""
+    started = time.perf_counter()
+    try:
+        # Run Python file with timeout
+        result = run_python_file(file_path)
+    except Exception as e:
+        return f'Execution error: {str(e)}'
+    finally:
+        metrics.observe('pastebin_execution_duration_seconds', time.perf_counter() - started, mode='run')
+    
+    return finish_execution_report(file_id, file_info, result, cache_status)
+
+def syntax_error_result(file_info):
+    return {'stdout': '', 'stderr': file_info['syntax_error']['message'], 'returncode': 1}
+
+def format_execution_report(file_id, file_info, result, cached_at=None):
+    status = execution_status(result['returncode'], result.get('usage'))
+    resources = f"Resources: {format_usage(result['usage'])}\n" if result.get('usage') else ''
+    cached = f"Cached: Yes (executed {cached_at.strftime('%Y-%m-%d %H:%M:%S')})\n" if cached_at else ''
+    return f"""=== Python Code Execution Result ===
+
+File: {file_info['original_name']}
+File ID: {file_id}
+Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+Status: {status}
+{resources}{cached}
+=== STDOUT ===
+{result['stdout']}
+
+=== STDERR ===
+{result['stderr']}
+"""
+
+# Streaming execution (?stream=1 for chunked text, ?stream=sse for Server-Sent Events)
+def _sse_event(event, text):
+    data = ''.join(f"data: {line}\n" for line in text.split('\n'))
+    return f"event: {event}\n{data}\n"
+
+class ExecutionStream:
+    """The report for ?stream=1 (chunked text) or ?stream=sse, piece by piece
+    
+    Shared by the threaded and the asyncio executor. In text mode a section
+    marker is written whenever the output switches streams and the status
+    moves to a footer, since it isn't known until the process exits.
+    """
+    
+    def __init__(self, file_id, file_info, sse=False):
+        self.file_id = file_id
+        self.file_info = file_info
+        self.sse = sse
+        self.decoders = {
+            'stdout': codecs.getincrementaldecoder('utf-8')('replace'),
+            'stderr': codecs.getincrementaldecoder('utf-8')('replace')
+        }
+        self.total = 0
+        self.section = None
+        self.status = None
+        self.usage = None
+    
+    def header(self):
+        header = f"""=== Python Code Execution Result ===
+
+File: {self.file_info['original_name']}
+File ID: {self.file_id}
+Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+"""
+        return _sse_event('header', header) if self.sse else header
+    
+    def syntax_error(self):
+        message = self.file_info['syntax_error']['message']
+        if self.sse:
+            return _sse_event('stderr', message) + _sse_event('status', 'Failed (Code: 1)')
+        return f"\n=== STDERR ===\n{message}\n\nStatus: Failed (Code: 1)\n"
+    
+    def feed(self, name, chunk):
+        """Text to send for bytes read from stdout or stderr; sets status once over the output cap"""
+        if self.total + len(chunk) > EXEC_STREAM_MAX_BYTES:
+            chunk = chunk[:EXEC_STREAM_MAX_BYTES - self.total]
+            self.status = f'Killed (output exceeded {EXEC_STREAM_MAX_BYTES} bytes)'
+        self.total += len(chunk)
+        
+        text = self.decoders[name].decode(chunk)
+        if not text:
+            return ''
+        if self.sse:
+            return _sse_event(name, text)
+        if self.section != name:
+            self.section = name
+            text = f"\n=== {name.upper()} ===\n{text}"
+        return text
+    
+    def timed_out(self):
+        self.status = f'Timed out ({EXEC_TIMEOUT} seconds)'
+    
+    def finished(self, returncode, usage):
+        """Record the reaped process; the status stays whatever stopped the run"""
+        self.usage = usage
+        if self.status is None:
+            self.status = execution_status(returncode, self.usage)
+        timed_out = self.status.startswith('Timed out')
+        execution_stats.record(self.file_id, returncode, timed_out, self.usage)
+        metrics.observe('pastebin_execution_cpu_seconds', self.usage['cpu_seconds'], mode='stream')
+        if timed_out:
+            metrics.inc('pastebin_execution_timeouts_total', mode='stream')
+    
+    def footer(self):
+        if self.sse:
+            usage = _sse_event('usage', json.dumps(self.usage)) if self.usage else ''
+            return usage + _sse_event('status', self.status)
+        resources = f"Resources: {format_usage(self.usage)}\n" if self.usage else ''
+        return f"\n\nStatus: {self.status}\n{resources}"
+
+def stream_execution(file_id, file_info, file_path, sse=False):
+    """Generator yielding the execution report while the script is running
+    
+    stdout/stderr are forwarded as soon as they are read.
+    """
+    stream = ExecutionStream(file_id, file_info, sse)
+    yield stream.header()
+    
+    if file_info.get('syntax_error'):
+        yield stream.syntax_error()
+        return
+    
+    with execution_backlog.slot(fresh_run_slots):
+        yield from _stream_fresh_run(stream, file_path)
+    yield stream.footer()
+
+def _stream_fresh_run(stream, file_path):
+    """The running part of stream_execution(): yields output until the script ends"""
+    import subprocess
+    proc, peak_fd = spawn_run(file_path, unbuffered=True)
+    selector = selectors.DefaultSelector()
+    selector.register(proc.stdout, selectors.EVENT_READ, 'stdout')
+    selector.register(proc.stderr, selectors.EVENT_READ, 'stderr')
+    started = time.monotonic()
+    deadline = started + EXEC_TIMEOUT
+    rusage = None
+    
+    try:
+        while stream.status is None and selector.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                stream.timed_out()
+                break
+            
+            for key, _ in selector.select(remaining):
+                chunk = os.read(key.fd, 8192)
+                if not chunk:
+                    selector.unregister(key.fileobj)
+                    continue
+                
+                text = stream.feed(key.data, chunk)
+                if text:
+                    yield text
+                if stream.status is not None:
+                    break
+        
+        if stream.status is None:
+            try:
+                rusage = wait_with_rusage(proc, max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                stream.timed_out()
+    finally:
+        # Also reached when the client disconnects and the generator is closed
+        kill_run(proc)
+        if rusage is None:
+            rusage = wait_with_rusage(proc)
+        selector.close()
+        proc.stdout.close()
+        proc.stderr.close()
+        wall_seconds = time.monotonic() - started
+        metrics.observe('pastebin_execution_duration_seconds', wall_seconds, mode='stream')
+        stream.finished(proc.returncode, resource_usage(rusage, wall_seconds, read_peak_rss(proc, peak_fd)))
+        remove_run_cgroup(proc.pid)
+
+# Asyncio executor, used by the execute route under asgi_app. Each run is an
+# asyncio subprocess awaited on the event loop, so an in-flight execution
+# holds no thread and one process can wait on many of them at once.
+_async_exec_slots = (None, None)
+
+def _async_exec_slot():
+    """One of EXEC_ASYNC_CONCURRENCY execution slots on the running loop (async with)"""
+    import asyncio
+    global _async_exec_slots
+    loop = asyncio.get_running_loop()
+    if _async_exec_slots[0] is not loop:
+        _async_exec_slots = (loop, asyncio.Semaphore(EXEC_ASYNC_CONCURRENCY))
+    return execution_backlog.async_slot(_async_exec_slots[1])
+
+class AsyncRun:
+    """A fresh-interpreter run driven from the event loop
+    
+    Started with Popen rather than asyncio's subprocess API: asyncio's child
+    watcher reaps its children itself with waitpid(), which throws away the
+    rusage. Here the exit is awaited on a pidfd (or, without one, on a
+    thread) and the process is reaped with wait4().
+    """
+    
+    def __init__(self, proc, peak_fd, stdout, stderr, transports):
+        self.proc = proc
+        self.peak_fd = peak_fd
+        self.peak_rss_kb = None
+        self.stdout = stdout
+        self.stderr = stderr
+        self.transports = transports
+        self.started = time.monotonic()
+        self.rusage = None
+        self.wall_seconds = None
+        self._reaping = None
+    
+    @classmethod
+    async def start(cls, file_path, unbuffered=False):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        proc, peak_fd = spawn_run(file_path, unbuffered)
+        readers, transports = [], []
+        for pipe in (proc.stdout, proc.stderr):
+            reader = asyncio.StreamReader()
+            transport, _ = await loop.connect_read_pipe(lambda reader=reader: asyncio.StreamReaderProtocol(reader), pipe)
+            readers.append(reader)
+            transports.append(transport)
+        return cls(proc, peak_fd, readers[0], readers[1], transports)
+    
+    async def wait(self):
+        """Wait for the process to exit and reap it; returns the returncode"""
+        import asyncio
+        if self.rusage is not None:
+            return self.proc.returncode
+        loop = asyncio.get_running_loop()
+        try:
+            pidfd = os.pidfd_open(self.proc.pid)
+        except (AttributeError, OSError):
+            pidfd = None
+        if pidfd is None:
+            # Reaped on a thread, started once and shielded so a cancelled
+            # request can't leave a second wait4() racing the first
+            if self._reaping is None:
+                self._reaping = loop.run_in_executor(None, wait_with_rusage, self.proc)
+            self.rusage = await asyncio.shield(self._reaping)
+        else:
+            exited = loop.create_future()
+            loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+            try:
+                await exited
+            finally:
+                loop.remove_reader(pidfd)
+                os.close(pidfd)
+            self.rusage = wait_with_rusage(self.proc, 0)
+        self.wall_seconds = time.monotonic() - self.started
+        return self.proc.returncode
+    
+    def usage(self):
+        return resource_usage(self.rusage, self.wall_seconds, self.peak_rss_kb)
+    
+    async def close(self):
+        """Kill the process if it is still running, reap it and close the pipes"""
+        kill_run(self.proc)
+        await self.wait()
+        if self.peak_fd is not None:
+            self.peak_rss_kb, self.peak_fd = read_peak_rss(self.proc, self.peak_fd), None
+            remove_run_cgroup(self.proc.pid)
+        for transport in self.transports:
+            transport.close()
+
+async def async_run_python_file(file_path):
+    """run_python_file() for the event loop, with the same result dict"""
+    import asyncio
+    run = await AsyncRun.start(file_path)
+    stdout = stderr = b''
+    timed_out = False
+    try:
+        stdout, stderr, _ = await asyncio.wait_for(
+            asyncio.gather(run.stdout.read(), run.stderr.read(), run.wait()), EXEC_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        timed_out = True
+    finally:
+        # Also reached when the request is cancelled because the client went away
+        await run.close()
+    return {
+        'stdout': stdout.decode('utf-8', 'replace'),
+        'stderr': stderr.decode('utf-8', 'replace'),
+        'returncode': run.proc.returncode,
+        'timed_out': timed_out,
+        'usage': run.usage()
+    }
+
+async def async_execution_report(file_id, file_info, file_path, cache_status):
+    """Async body for a plain ?file_id= run whose report wasn't answered from the cache"""
+    started = time.perf_counter()
+    try:
+        async with _async_exec_slot():
+            result = await async_run_python_file(file_path)
+    except Exception as e:
+        output = f'Execution error: {str(e)}'
+    else:
+        output = finish_execution_report(file_id, file_info, result, cache_status)
+    finally:
+        metrics.observe('pastebin_execution_duration_seconds', time.perf_counter() - started, mode='run')
+    yield output.encode('utf-8')
+
+async def async_stream_execution(file_id, file_info, file_path, sse=False):
+    """stream_execution() for the event loop, yielding bytes"""
+    import asyncio
+    stream = ExecutionStream(file_id, file_info, sse)
+    yield stream.header().encode('utf-8')
+    
+    if file_info.get('syntax_error'):
+        yield stream.syntax_error().encode('utf-8')
+        return
+    
+    async with _async_exec_slot():
+        run = await AsyncRun.start(file_path, unbuffered=True)
+        pipes = {'stdout': run.stdout, 'stderr': run.stderr}
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + EXEC_TIMEOUT
+        reads = {asyncio.ensure_future(pipe.read(8192)): name for name, pipe in pipes.items()}
+        try:
+            while stream.status is None and reads:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    stream.timed_out()
+                    break
+                
+                done, _ = await asyncio.wait(reads, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = reads.pop(task)
+                    chunk = task.result()
+                    if not chunk:
+                        continue
+                    reads[asyncio.ensure_future(pipes[name].read(8192))] = name
+                    
+                    text = stream.feed(name, chunk)
+                    if text:
+                        yield text.encode('utf-8')
+                    if stream.status is not None:
+                        break
+            
+            if stream.status is None:
+                try:
+                    await asyncio.wait_for(run.wait(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    stream.timed_out()
+        finally:
+            for task in reads:
+                task.cancel()
+            await run.close()
+            metrics.observe('pastebin_execution_duration_seconds', run.wall_seconds, mode='stream')
+            stream.finished(run.proc.returncode, run.usage())
+    
+    yield stream.footer().encode('utf-8')
+
+class ExecutionCache:
+    """LRU + TTL cache of execution results keyed by (content hash, interpreter)"""
+    
+    def __init__(self, ttl, max_entries, max_bytes):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @staticmethod
+    def _entry_size(result):
+        return len(result['stdout']) + len(result['stderr'])
+    
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= self._entry_size(entry['result'])
+    
+    def get(self, blob_hash):
+        key = (blob_hash, INTERPRETER_VERSION)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry['stored'] > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+    
+    def put(self, blob_hash, result):
+        size = self._entry_size(result)
+        if size > self.max_bytes:
+            return
+        key = (blob_hash, INTERPRETER_VERSION)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = {
+                'result': result,
+                'stored': time.monotonic(),
+                'executed_at': datetime.now()
+            }
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+    
+    def invalidate(self, blob_hash):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == blob_hash]:
+                self._remove(key)
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+execution_cache = ExecutionCache(EXEC_CACHE_TTL, EXEC_CACHE_MAX_ENTRIES, EXEC_CACHE_MAX_BYTES)
+
+# Asynchronous execution jobs
+class QueueFullError(RuntimeError):
+    pass
+
+class JobScheduler:
+    """Runs submitted jobs on a bounded number of threads
+    
+    With policy 'fifo' jobs run in submission order; with 'fair' each client
+    has its own queue and clients are served round-robin, so one client
+    queueing many jobs can't starve the others.
+    """
+    
+    def __init__(self, concurrency, max_queued, policy, retention):
+        self.concurrency = concurrency
+        self.max_queued = max_queued
+        self.policy = policy
+        self.retention = retention
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()
+        self._queued = 0
+        self._running = 0
+        self._jobs = {}
+        self._finished = deque()
+        self._threads = []
+        self.completed = 0
+        self.rejected = 0
+    
+    def _purge(self):
+        cutoff = time.monotonic() - self.retention
+        while self._finished and self._finished[0][0] < cutoff:
+            self._jobs.pop(self._finished.popleft()[1], None)
+    
+    def submit(self, client, fn, **details):
+        with self._cond:
+            self._purge()
+            if self._queued >= self.max_queued:
+                self.rejected += 1
+                raise QueueFullError(f'Execution queue is full ({self.max_queued} jobs)')
+            
+            job = {
+                'job_id': uuid.uuid4().hex,
+                'status': 'queued',
+                'submitted_at': datetime.now().isoformat(),
+                **details
+            }
+            key = client if self.policy == 'fair' else None
+            self._queues.setdefault(key, deque()).append((job, fn))
+            self._queued += 1
+            self._jobs[job['job_id']] = job
+            
+            if len(self._threads) < self.concurrency:
+                thread = threading.Thread(target=self._worker, daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            self._cond.notify()
+            return dict(job)
+    
+    def _next_job(self):
+        # Take from the first client's queue and move that client to the back
+        key, queue = next(iter(self._queues.items()))
+        job, fn = queue.popleft()
+        del self._queues[key]
+        if queue:
+            self._queues[key] = queue
+        self._queued -= 1
+        return job, fn
+    
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queued:
+                    self._cond.wait()
+                job, fn = self._next_job()
+                self._running += 1
+                job['status'] = 'running'
+                job['started_at'] = datetime.now().isoformat()
+            
+            try:
+                output, status, error = fn(), 'done', None
+            except Exception as e:
+                output, status, error = None, 'failed', str(e)
+            
+            with self._cond:
+                self._running -= 1
+                self.completed += 1
+                job.update(status=status, output=output, finished_at=datetime.now().isoformat())
+                if error:
+                    job['error'] = error
+                self._finished.append((time.monotonic(), job['job_id']))
+    
+    def get(self, job_id):
+        with self._cond:
+            self._purge()
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+    
+    def stats(self):
+        with self._cond:
+            return {
+                'policy': self.policy,
+                'concurrency': self.concurrency,
+                'queued': self._queued,
+                'running': self._running,
+                'max_queued': self.max_queued,
+                'completed': self.completed,
+                'rejected': self.rejected
+            }
+
+job_scheduler = JobScheduler(EXEC_JOB_CONCURRENCY, EXEC_JOB_MAX_QUEUED,
+                             EXEC_JOB_POLICY, EXEC_JOB_RETENTION)
+
+def client_id():
+    """Client identity for rate limits and fair scheduling
+    
+    The address the outermost of TRUSTED_PROXY_HOPS proxies saw, or the peer
+    address when none are configured (under handler() that is the address
+    the platform put in X-Forwarded-For).
+    """
+    if TRUSTED_PROXY_HOPS:
+        hops = [hop.strip() for hop in request.headers.get('X-Forwarded-For', '').split(',') if hop.strip()]
+        if len(hops) >= TRUSTED_PROXY_HOPS:
+            return hops[-TRUSTED_PROXY_HOPS]
+    return request.remote_addr or 'unknown'
+
+# Admission control: token-bucket rate limits and execution load shedding
+def parse_rate(spec):
+    """'N/S' -> (capacity N, N / S tokens per second); None when disabled"""
+    spec = (spec or '').strip()
+    if spec in ('', '0'):
+        return None
+    count, _, seconds = spec.partition('/')
+    count, seconds = float(count), float(seconds or 1)
+    if count <= 0 or seconds <= 0:
+        raise ValueError(f'Invalid rate limit {spec!r}: expected N/S with N, S > 0')
+    return count, count / seconds
+
+class MemoryBucketStore:
+    """Token buckets in this process's memory
+    
+    Limits apply per process (and per serverless instance). A shared store
+    only needs the same take() so every worker draws from the same buckets.
+    Idle buckets are evicted least recently used first; an evicted bucket
+    comes back full.
+    """
+    
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # key -> [tokens, last refill]
+    
+    def take(self, buckets, cost=1):
+        """Take cost tokens from every (key, capacity, per_second) bucket, or from none
+        
+        Returns None when admitted, else (index of the first bucket that is
+        short, seconds until it has enough).
+        """
+        now = time.monotonic()
+        with self._lock:
+            states = []
+            for i, (key, capacity, per_second) in enumerate(buckets):
+                state = self._buckets.get(key)
+                if state is None:
+                    state = self._buckets[key] = [capacity, now]
+                else:
+                    self._buckets.move_to_end(key)
+                    state[0] = min(capacity, state[0] + (now - state[1]) * per_second)
+                    state[1] = now
+                if state[0] < cost:
+                    return i, (cost - state[0]) / per_second
+                states.append(state)
+            for state in states:
+                state[0] -= cost
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return None
+    
+    def __len__(self):
+        return len(self._buckets)
+
+class RateLimiter:
+    """Per-client and global token buckets for each route group in RATE_LIMITS"""
+    
+    SCOPES = ('client', 'global')
+    
+    def __init__(self, limits, store):
+        self.limits = {group: {scope: parse_rate(scopes.get(scope)) for scope in self.SCOPES}
+                       for group, scopes in limits.items()}
+        self.store = store
+        self.limited = 0
+    
+    def check(self, group, client):
+        """None when admitted, else (scope, seconds to wait)"""
+        scopes, buckets = [], []
+        for scope, rate in self.limits.get(group, {}).items():
+            if rate is not None:
+                key = f'{group}:{client}' if scope == 'client' else f'{group}:*'
+                scopes.append(scope)
+                buckets.append((key, *rate))
+        if not buckets:
+            return None
+        
+        blocked = self.store.take(buckets)
+        if blocked is None:
+            return None
+        self.limited += 1
+        index, wait = blocked
+        return scopes[index], wait
+    
+    def stats(self):
+        return {
+            'enabled': RATE_LIMITING,
+            'limits': {group: {scope: RATE_LIMITS[group].get(scope) if rate else None
+                               for scope, rate in scopes.items()}
+                       for group, scopes in self.limits.items()},
+            'clients_tracked': len(self.store),
+            'limited': self.limited
+        }
+
+rate_limiter = RateLimiter(RATE_LIMITS, MemoryBucketStore(RATE_LIMIT_MAX_CLIENTS))
 
-def save_passwords(passwords):
-    with open(PASSWORD_FILE, 'w') as f:
-        json.dump(passwords, f, indent=2)
+class OverloadedError(RuntimeError):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
 
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+class ExecutionBacklog:
+    """Counts runs waiting for and holding execution slots, so execute can shed load
+    
+    Every executor takes its slots through slot() or async_slot(): the warm
+    pool, fresh interpreters (fresh_run_slots) and the asyncio executor.
+    Before queueing another run the execute route calls
+    admit(), which refuses once max_waiting runs are already waiting, with a
+    Retry-After estimated from the backlog and the recent run time.
+    """
+    
+    def __init__(self, max_waiting):
+        self.max_waiting = max_waiting
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.running = 0
+        self.shed = 0
+        self.mean_run_seconds = 1.0  # Moving average of slot hold times
+    
+    def _stop_waiting(self, acquired):
+        with self._lock:
+            self.waiting -= 1
+            if acquired:
+                self.running += 1
+        return time.monotonic()
+    
+    def _leave(self, started):
+        with self._lock:
+            self.running -= 1
+            self.mean_run_seconds += 0.2 * (time.monotonic() - started - self.mean_run_seconds)
+    
+    @contextmanager
+    def slot(self, semaphore):
+        """Hold a threading semaphore as an execution slot"""
+        with self._lock:
+            self.waiting += 1
+        acquired = False
+        try:
+            semaphore.acquire()
+            acquired = True
+        finally:
+            started = self._stop_waiting(acquired)
+        try:
+            yield
+        finally:
+            semaphore.release()
+            self._leave(started)
+    
+    @asynccontextmanager
+    async def async_slot(self, semaphore):
+        """Hold an asyncio semaphore as an execution slot"""
+        with self._lock:
+            self.waiting += 1
+        acquired = False
+        try:
+            await semaphore.acquire()
+            acquired = True
+        finally:
+            started = self._stop_waiting(acquired)
+        try:
+            yield
+        finally:
+            semaphore.release()
+            self._leave(started)
+    
+    def retry_after(self, waiting=None, slots=None):
+        """Whole seconds until a run queued now would likely get a slot"""
+        with self._lock:
+            waiting = self.waiting if waiting is None else waiting
+            slots = slots or max(self.running, 1)
+            return max(1, math.ceil((waiting + 1) * self.mean_run_seconds / slots))
+    
+    def admit(self):
+        """Raise OverloadedError when too many runs are already waiting"""
+        with self._lock:
+            overloaded = self.max_waiting and self.waiting >= self.max_waiting
+            if overloaded:
+                self.shed += 1
+                waiting = self.waiting
+        if overloaded:
+            metrics.inc('pastebin_load_shed_total', queue='execute')
+            raise OverloadedError(f'Server busy: {waiting} executions are already waiting',
+                                  self.retry_after())
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'waiting': self.waiting,
+                'running': self.running,
+                'max_waiting': self.max_waiting,
+                'mean_run_seconds': round(self.mean_run_seconds, 3),
+                'shed': self.shed
+            }
 
-def generate_file_id():
-    return str(uuid.uuid4())[:8]
+execution_backlog = ExecutionBacklog(EXEC_MAX_WAITING)
 
-def sanitize_filename(filename):
-    """Sanitize filename to prevent path traversal"""
-    import re
-    filename = os.path.basename(filename)
-    filename = re.sub(r'[^\w\.\-]', '_', filename)
-    return filename[:100]
+def retry_later(message, status, retry_after):
+    """JSON error for a refused request, with Retry-After in whole seconds"""
+    retry_after = max(1, math.ceil(retry_after))
+    response = jsonify({'error': message, 'retry_after': retry_after})
+    response.status_code = status
+    response.headers['Retry-After'] = str(retry_after)
+    return response
 
 # HTML Templates
 UPLOAD_PAGE = '''
@@ -192,59 +3559,49 @@ UPLOAD_PAGE = '''
                 return;
             }
             
-            const reader = new FileReader();
-            reader.onload = async function(e) {
-                const content = e.target.result;
-                const base64Content = btoa(unescape(encodeURIComponent(content)));
-                
-                const response = await fetch('/api/upload', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
-                    body: JSON.stringify({
-                        filename: file.name,
-                        content: base64Content,
-                        is_private: isPrivate,
-                        password: password
-                    })
-                });
-                
-                const result = await response.json();
-                
-                if (response.ok) {
-                    const resultHTML = `
-                        <div class="result">
-                            <h3>✅ Upload Successful!</h3>
-                            <p><strong>File ID:</strong> ${result.file_id}</p>
-                            <p><strong>Filename:</strong> ${file.name}</p>
-                            ${result.is_private ? '<span class="private-badge">🔒 PRIVATE</span>' : ''}
-                            
-                            <p><strong>📄 Raw URL:</strong></p>
-                            <div class="url-box">
-                                <a href="${result.raw_url}" target="_blank">${result.raw_url}</a>
-                            </div>
-                            
-                            <p><strong>🚀 Execute URL:</strong></p>
-                            <div class="url-box">
-                                <a href="${result.execute_url}" target="_blank">${result.execute_url}</a>
-                            </div>
-                            
-                            ${result.is_private ? 
-                                '<p style="color: #ff6b6b;">🔒 Password protected - password required to access</p>' : 
-                                ''
-                            }
-                        </div>
-                    `;
-                    
-                    document.getElementById('result').innerHTML = resultHTML;
-                } else {
-                    document.getElementById('result').innerHTML = 
-                        `<p style="color: red;">Error: ${result.error}</p>`;
-                }
-            };
+            // Sent as multipart/form-data so the server can stream it to disk
+            const formData = new FormData();
+            formData.append('file', file, file.name);
+            formData.append('is_private', isPrivate);
+            formData.append('password', password);
+            
+            const response = await fetch('/api/upload', {
+                method: 'POST',
+                body: formData
+            });
             
-            reader.readAsText(file);
+            const result = await response.json();
+            
+            if (response.ok) {
+                const resultHTML = `
+                    <div class="result">
+                        <h3>✅ Upload Successful!</h3>
+                        <p><strong>File ID:</strong> ${result.file_id}</p>
+                        <p><strong>Filename:</strong> ${file.name}</p>
+                        ${result.is_private ? '<span class="private-badge">🔒 PRIVATE</span>' : ''}
+                        
+                        <p><strong>📄 Raw URL:</strong></p>
+                        <div class="url-box">
+                            <a href="${result.raw_url}" target="_blank">${result.raw_url}</a>
+                        </div>
+                        
+                        <p><strong>🚀 Execute URL:</strong></p>
+                        <div class="url-box">
+                            <a href="${result.execute_url}" target="_blank">${result.execute_url}</a>
+                        </div>
+                        
+                        ${result.is_private ? 
+                            '<p style="color: #ff6b6b;">🔒 Password protected - password required to access</p>' : 
+                            ''
+                        }
+                    </div>
+                `;
+                
+                document.getElementById('result').innerHTML = resultHTML;
+            } else {
+                document.getElementById('result').innerHTML = 
+                    `<p style="color: red;">Error: ${result.error}</p>`;
+            }
         }
     </script>
 </body>
@@ -304,64 +3661,160 @@ PASSWORD_FORM = '''
 </html>
 '''
 
+# Templates are compiled once, on first use. The upload page has no
+# per-request data, so it is also rendered and gzipped once and served with
+# an ETag.
+_password_form_template = None
+
+def render_password_form(file_id):
+    global _password_form_template
+    if _password_form_template is None:
+        _password_form_template = app.jinja_env.from_string(PASSWORD_FORM)
+    return _password_form_template.render(
+        file_id=file_id,
+        action_url=f"{request.path}?file_id={file_id}"
+    )
+
+class StaticPage:
+    """A template rendered once, on first request, and kept in memory both as is and gzipped"""
+    
+    def __init__(self, source):
+        self.source = source
+        self.body = None
+    
+    def _render(self):
+        import gzip
+        body = app.jinja_env.from_string(self.source).render().encode('utf-8')
+        self.gzipped = gzip.compress(body, compresslevel=9, mtime=0)
+        self.etag = hashlib.sha256(body).hexdigest()[:16]
+        # Set last, so a concurrent first request never sees a half-built page
+        self.body = body
+    
+    def response(self):
+        if self.body is None:
+            self._render()
+        send_gzip = request.accept_encodings['gzip'] > 0
+        response = Response(self.gzipped if send_gzip else self.body, mimetype='text/html')
+        if send_gzip:
+            response.content_encoding = 'gzip'
+        response.set_etag(f"{self.etag}-gzip" if send_gzip else self.etag)
+        response.vary.add('Accept-Encoding')
+        # Always revalidate, so a deploy shows up at once; the 304 costs next to nothing
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+upload_page = StaticPage(UPLOAD_PAGE)
+
+# Request metrics, Server-Timing and structured request logs
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.before_request
+def check_rate_limit():
+    group = RATE_LIMITED_ENDPOINTS.get(request.endpoint)
+    if not RATE_LIMITING or group is None:
+        return None
+    limited = rate_limiter.check(group, client_id())
+    if limited is None:
+        return None
+    
+    scope, wait = limited
+    metrics.inc('pastebin_rate_limited_total', route=group, scope=scope)
+    if scope == 'client':
+        return retry_later(f'Rate limit exceeded for {group} requests', 429, wait)
+    # The shared bucket is empty: the server is busy, not this client
+    return retry_later(f'Server busy: too many {group} requests', 503, wait)
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    elapsed = time.perf_counter() - g.get('request_started', time.perf_counter())
+    metrics.inc('pastebin_http_requests_total', route=route, method=request.method,
+                status=str(response.status_code))
+    metrics.observe('pastebin_http_request_duration_seconds', elapsed, route=route)
+    
+    timings = g.get('timings', {})
+    response.headers['Server-Timing'] = ', '.join(
+        [f"{phase};dur={seconds * 1000:.2f}" for phase, seconds in timings.items()] +
+        [f"total;dur={elapsed * 1000:.2f}"]
+    )
+    if REQUEST_LOG:
+        logger.info(json.dumps({
+            'event': 'request',
+            'time': datetime.now().isoformat(),
+            'method': request.method,
+            'route': route,
+            'file_id': request.args.get('file_id'),
+            'status': response.status_code,
+            'duration_ms': round(elapsed * 1000, 2),
+            'phases_ms': {phase: round(seconds * 1000, 2) for phase, seconds in timings.items()}
+        }))
+    return response
+
 # Routes
 @app.route('/')
 def home():
-    return render_template_string(UPLOAD_PAGE)
+    return upload_page.response()
 
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
+    blob = None
     try:
-        data = request.get_json()
-        if not data:
-            return jsonify({'error': 'No data provided'}), 400
+        # JSON bodies carry base64 content; multipart/form-data and
+        # application/octet-stream bodies are streamed to disk in chunks
+        try:
+            fields, blob = read_upload_request()
+        except UploadError as e:
+            return jsonify({'error': str(e)}), 400
         
-        filename = data.get('filename', '').strip()
-        content = data.get('content', '').strip()
-        is_private = data.get('is_private', False)
-        password = data.get('password', '').strip()
+        filename = fields.get('filename', '').strip()
+        is_private = _form_flag(fields.get('is_private', False))
+        password = fields.get('password', '').strip()
         
-        if not filename or not content:
+        if not filename or blob is None:
             return jsonify({'error': 'Missing filename or content'}), 400
         
         if not filename.endswith('.py'):
             return jsonify({'error': 'Only Python files (.py) are allowed'}), 400
         
+        try:
+            expires_at = parse_ttl(fields.get('ttl'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
         # Sanitize filename
         filename = sanitize_filename(filename)
         
         # Generate unique ID
         file_id = generate_file_id()
-        save_filename = f"{file_id}_{filename}"
-        file_path = os.path.join(UPLOAD_FOLDER, save_filename)
-        
-        # Decode and save file
-        try:
-            file_content = base64.b64decode(content)
-        except:
-            return jsonify({'error': 'Invalid file encoding'}), 400
         
-        with open(file_path, 'wb') as f:
-            f.write(file_content)
+        # Compile once now; execute then runs the cached bytecode
+        with timed('compile'):
+            syntax_error = precompile_blob(blob)
+        with timed('compress'):
+            compress_blob(blob)
         
         # Store metadata
-        files_data = load_data()
-        passwords_data = load_passwords()
-        
-        files_data[file_id] = {
+        file_info = {
             'original_name': filename,
-            'saved_name': save_filename,
+            'blob_hash': blob.hash,
             'upload_time': datetime.now().isoformat(),
             'is_private': is_private,
             'has_password': bool(password and is_private),
-            'size_bytes': len(file_content)
+            'size_bytes': blob.size_bytes
         }
+        if syntax_error:
+            file_info['syntax_error'] = syntax_error
+        if expires_at:
+            file_info['expires_at'] = expires_at
         
-        if is_private and password:
-            passwords_data[file_id] = hash_password(password)
-        
-        save_data(files_data)
-        save_passwords(passwords_data)
+        with timed('db'):
+            save_file_info(file_id, file_info,
+                           hash_password(password) if is_private and password else None,
+                           blob=blob)
+        if storage_sweeper.over_quota():
+            storage_sweeper.wake()
         
         # Get base URL
         base_url = request.host_url.rstrip('/')
@@ -370,17 +3823,109 @@ def upload_file():
             'success': True,
             'file_id': file_id,
             'filename': filename,
+            'content_hash': blob.hash,
             'raw_url': f"{base_url}/api/raw?file_id={file_id}",
             'execute_url': f"{base_url}/api/execute?file_id={file_id}",
             'is_private': is_private,
             'has_password': bool(password and is_private),
+            'expires_at': expires_at,
             'message': 'File uploaded successfully'
         }
+        if syntax_error:
+            response['syntax_error'] = syntax_error
         
         return jsonify(response), 200
         
     except Exception as e:
         return jsonify({'error': f'Server error: {str(e)}'}), 500
+    finally:
+        if blob is not None:
+            blob.discard()
+
+@app.route('/api/upload/batch', methods=['POST'])
+def upload_batch():
+    files = []
+    try:
+        try:
+            fields, files = read_batch_upload_request()
+        except UploadError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        is_private = _form_flag(fields.get('is_private', False))
+        password = fields.get('password', '').strip()
+        password_hash = hash_password(password) if is_private and password else None
+        upload_time = datetime.now().isoformat()
+        try:
+            expires_at = parse_ttl(fields.get('ttl'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        entries = []
+        skipped = []
+        for filename, blob in files:
+            filename = sanitize_filename(filename.strip())
+            if not filename.endswith('.py'):
+                skipped.append({'filename': filename, 'error': 'Only Python files (.py) are allowed'})
+                continue
+            if blob is None or blob.size_bytes == 0:
+                skipped.append({'filename': filename, 'error': 'Missing content'})
+                continue
+            
+            with timed('compile'):
+                syntax_error = precompile_blob(blob)
+            with timed('compress'):
+                compress_blob(blob)
+            
+            file_info = {
+                'original_name': filename,
+                'blob_hash': blob.hash,
+                'upload_time': upload_time,
+                'is_private': is_private,
+                'has_password': bool(password and is_private),
+                'size_bytes': blob.size_bytes
+            }
+            if syntax_error:
+                file_info['syntax_error'] = syntax_error
+            if expires_at:
+                file_info['expires_at'] = expires_at
+            entries.append((generate_file_id(), file_info, password_hash, blob))
+        
+        if not entries:
+            return jsonify({'error': 'No Python files in batch', 'skipped': skipped}), 400
+        
+        # One transaction (and one commit) for the whole batch
+        with timed('db'):
+            save_files(entries)
+        if storage_sweeper.over_quota():
+            storage_sweeper.wake()
+        
+        base_url = request.host_url.rstrip('/')
+        uploaded = []
+        for file_id, file_info, _, _ in entries:
+            item = {
+                'file_id': file_id,
+                'filename': file_info['original_name'],
+                'raw_url': f"{base_url}/api/raw?file_id={file_id}",
+                'execute_url': f"{base_url}/api/execute?file_id={file_id}"
+            }
+            if file_info.get('syntax_error'):
+                item['syntax_error'] = file_info['syntax_error']
+            uploaded.append(item)
+        
+        return jsonify({
+            'success': True,
+            'files': uploaded,
+            'skipped': skipped,
+            'is_private': is_private,
+            'has_password': bool(password and is_private),
+            'expires_at': expires_at,
+            'message': f'{len(uploaded)} files uploaded successfully'
+        }), 200
+        
+    except Exception as e:
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+    finally:
+        _discard_staged(files)
 
 @app.route('/api/raw')
 def raw_file():
@@ -391,41 +3936,147 @@ def raw_file():
         if not file_id:
             return 'Missing file_id parameter', 400
         
-        files_data = load_data()
+        with timed('lookup'):
+            file_info = get_file_info(file_id)
         
-        if file_id not in files_data:
+        if file_info is None:
             return 'File not found', 404
         
-        file_info = files_data[file_id]
-        
         # Check password if needed
         if file_info['is_private'] and file_info['has_password']:
             if not password:
                 # Show password form
-                return render_template_string(PASSWORD_FORM, 
-                    file_id=file_id,
-                    action_url=f"{request.path}?file_id={file_id}"
-                )
+                return render_password_form(file_id)
             
             # Verify password
-            passwords_data = load_passwords()
-            if file_id not in passwords_data or \
-               passwords_data[file_id] != hash_password(password):
+            with timed('auth'):
+                password_ok = get_password_hash(file_id) == hash_password(password)
+            if not password_ok:
                 return 'Invalid password', 403
         
+        access_tracker.touch(file_id)
+        
+        try:
+            version = requested_version(file_info)
+        except ValueError:
+            return 'version must be a number', 400
+        if version is not None:
+            found = version_file(file_id, version)
+            if found is None:
+                return 'Version not found', 404
+            version_info, version_path = found
+            # Versions never change once archived
+            response = send_file(
+                version_path,
+                mimetype='text/plain',
+                download_name=version_info['original_name'],
+                etag=version_info['blob_hash'],
+                last_modified=datetime.fromisoformat(version_info['upload_time']),
+                max_age=None if file_info['is_private'] else RAW_CACHE_MAX_AGE
+            )
+            if file_info['is_private']:
+                response.cache_control.private = True
+            return response
+        
         # Serve the file
-        file_path = os.path.join(UPLOAD_FOLDER, file_info['saved_name'])
+        file_path = content_path(file_info)
         
         if os.path.exists(file_path):
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            return content, 200, {'Content-Type': 'text/plain; charset=utf-8'}
+            compressed = file_info.get('encoding') == 'gzip'
+            send_gzip = compressed and request.accept_encodings['gzip'] > 0
+            etag = file_info.get('blob_hash', True)
+            if send_gzip:
+                # The two representations need distinct validators
+                etag = f"{etag}-gzip"
+            
+            # Streamed via wsgi.file_wrapper (sendfile under gunicorn), with
+            # If-None-Match/If-Modified-Since -> 304 and Range -> 206 handling
+            response = send_file(
+                io.BytesIO() if compressed and not send_gzip else file_path,
+                mimetype='text/plain',
+                download_name=file_info['original_name'],
+                conditional=not compressed or send_gzip,
+                etag=etag,
+                last_modified=datetime.fromisoformat(file_info['upload_time']),
+                max_age=None if file_info['is_private'] else RAW_CACHE_MAX_AGE
+            )
+            if compressed and not send_gzip:
+                # send_file only built the headers; decompress for this client
+                response.response = gunzip_chunks(file_path)
+                response.content_length = file_info['size_bytes']
+                response.make_conditional(request, accept_ranges=True,
+                                          complete_length=file_info['size_bytes'])
+            if send_gzip:
+                response.content_encoding = 'gzip'
+            if compressed:
+                response.vary.add('Accept-Encoding')
+            if file_info['is_private']:
+                response.cache_control.private = True
+            return response
         else:
             return 'File not found', 404
             
     except Exception as e:
         return f'Server error: {str(e)}', 500
 
+@app.route('/api/download/batch', methods=['GET', 'POST'])
+def download_batch():
+    try:
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or {}
+            if not isinstance(data, dict):
+                return jsonify({'error': 'Body must be a JSON object with file_ids'}), 400
+            file_ids = data.get('file_ids', [])
+            if not isinstance(file_ids, list) or not all(isinstance(file_id, str) for file_id in file_ids):
+                return jsonify({'error': 'file_ids must be a list of strings'}), 400
+            archive_format = data.get('format', 'tar')
+            password = str(data.get('password', '')).strip()
+        else:
+            # ?file_id=a&file_id=b or ?file_ids=a,b
+            file_ids = request.args.getlist('file_id')
+            for value in request.args.getlist('file_ids'):
+                file_ids.extend(value.split(','))
+            archive_format = request.args.get('format', 'tar')
+            password = request.args.get('password', '').strip()
+        
+        if len(file_ids) > BATCH_MAX_FILES:
+            return jsonify({'error': f'At most {BATCH_MAX_FILES} files per batch'}), 400
+        file_ids = list(dict.fromkeys(file_id.strip() for file_id in file_ids if file_id.strip()))
+        if not file_ids:
+            return jsonify({'error': 'Missing file_ids'}), 400
+        if archive_format not in ('tar', 'zip'):
+            return jsonify({'error': "format must be 'tar' or 'zip'"}), 400
+        
+        # Everything is checked before the first byte is sent
+        entries = []
+        missing = []
+        forbidden = []
+        with timed('lookup'):
+            for file_id in file_ids:
+                file_info = get_file_info(file_id)
+                if file_info is None or not os.path.exists(content_path(file_info)):
+                    missing.append(file_id)
+                    continue
+                if file_info['is_private'] and file_info['has_password']:
+                    if not password or get_password_hash(file_id) != hash_password(password):
+                        forbidden.append(file_id)
+                        continue
+                entries.append((file_id, file_info))
+        if missing:
+            return jsonify({'error': 'File not found', 'file_ids': missing}), 404
+        if forbidden:
+            return jsonify({'error': 'Invalid password', 'file_ids': forbidden}), 403
+        
+        stream = zip_stream(entries) if archive_format == 'zip' else tar_stream(entries)
+        response = Response(stream, mimetype=f'application/{"zip" if archive_format == "zip" else "x-tar"}',
+                            direct_passthrough=True)
+        response.headers.set('Content-Disposition', 'attachment', filename=f'pastes.{archive_format}')
+        response.cache_control.no_store = True
+        return response
+        
+    except Exception as e:
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+
 @app.route('/api/execute')
 def execute_file():
     try:
@@ -435,134 +4086,201 @@ def execute_file():
         if not file_id:
             return 'Missing file_id parameter', 400
         
-        files_data = load_data()
+        with timed('lookup'):
+            file_info = get_file_info(file_id)
         
-        if file_id not in files_data:
+        if file_info is None:
             return 'File not found', 404
         
-        file_info = files_data[file_id]
-        
         # Check password if needed
         if file_info['is_private'] and file_info['has_password']:
             if not password:
                 # Show password form
-                return render_template_string(PASSWORD_FORM,
-                    file_id=file_id,
-                    action_url=f"{request.path}?file_id={file_id}"
-                )
+                return render_password_form(file_id)
             
             # Verify password
-            passwords_data = load_passwords()
-            if file_id not in passwords_data or \
-               passwords_data[file_id] != hash_password(password):
+            with timed('auth'):
+                password_ok = get_password_hash(file_id) == hash_password(password)
+            if not password_ok:
                 return 'Invalid password', 403
         
-        # Execute the file
-        file_path = os.path.join(UPLOAD_FOLDER, file_info['saved_name'])
+        access_tracker.touch(file_id)
+        
+        try:
+            version = requested_version(file_info)
+        except ValueError:
+            return 'version must be a number', 400
+        if version is not None:
+            # An archived version, rebuilt into a source file of its own
+            found = version_file(file_id, version)
+            if found is None:
+                return 'Version not found', 404
+            file_info, file_path = found
+        else:
+            # Execute the file
+            file_path = content_path(file_info)
+        
+        # Opt-in result cache (?cache=1) for deterministic scripts; keyed by
+        # content hash, so results for stale content are never served
+        use_cache = _form_flag(request.args.get('cache', ''))
         
         if os.path.exists(file_path):
-            try:
-                # Run Python file with timeout
-                result = subprocess.run(
-                    ['python', file_path],
-                    capture_output=True,
-                    text=True,
-                    timeout=10,
-                    encoding='utf-8'
+            # Run the bytecode compiled at upload time when it's available
+            if version is None:
+                file_path = executable_path(file_info)
+            
+            stream_mode = request.args.get('stream', '').strip().lower()
+            if stream_mode == 'sse' or _form_flag(stream_mode):
+                sse = stream_mode == 'sse'
+                if not file_info.get('syntax_error'):
+                    execution_backlog.admit()
+                if ASGI_ENVIRON_KEY in request.environ:
+                    body = async_stream_execution(file_id, file_info, file_path, sse=sse)
+                    response = async_response
+                else:
+                    body = stream_execution(file_id, file_info, file_path, sse=sse)
+                    response = Response
+                return response(
+                    body,
+                    mimetype='text/event-stream' if sse else 'text/plain',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
                 )
+            
+            if _form_flag(request.args.get('async', '')):
+                # Queue the run and hand back a job id to poll
+                try:
+                    job = job_scheduler.submit(
+                        client_id(),
+                        lambda: execute_and_report(file_id, file_info, file_path, use_cache)[0],
+                        file_id=file_id
+                    )
+                except QueueFullError as e:
+                    stats = job_scheduler.stats()
+                    return retry_later(str(e), 503, execution_backlog.retry_after(stats['queued'],
+                                                                                   stats['concurrency']))
                 
-                output = f"""=== Python Code Execution Result ===
-
-File: {file_info['original_name']}
-File ID: {file_id}
-Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-Status: {'Success' if result.returncode == 0 else f'Failed (Code: {result.returncode})'}
-
-=== STDOUT ===
-{result.stdout}
-
-=== STDERR ===
-{result.stderr}
-"""
-                return output, 200, {'Content-Type': 'text/plain; charset=utf-8'}
-                
-            except subprocess.TimeoutExpired:
-                return 'Execution timed out (10 seconds)', 200
-            except Exception as e:
-                return f'Execution error: {str(e)}', 200
+                base_url = request.host_url.rstrip('/')
+                job['status_url'] = f"{base_url}/api/job?job_id={job['job_id']}"
+                return jsonify(job), 202
+            
+            output, cache_status = cached_execution_report(file_id, file_info, use_cache)
+            headers = {'Content-Type': 'text/plain; charset=utf-8', 'X-Execution-Cache': cache_status}
+            if output is None:
+                # Needs a process: shed now rather than queue behind a full backlog
+                execution_backlog.admit()
+                if ASGI_ENVIRON_KEY in request.environ:
+                    return async_response(async_execution_report(file_id, file_info, file_path, cache_status),
+                                          headers=headers)
+                with timed('exec'):
+                    output = run_and_report(file_id, file_info, file_path, cache_status)
+            return output, 200, headers
         else:
             return 'File not found', 404
             
+    except OverloadedError as e:
+        return retry_later(str(e), 503, e.retry_after)
     except Exception as e:
         return f'Server error: {str(e)}', 500
 
 @app.route('/api/update', methods=['POST'])
 def update_file():
+    blob = None
     try:
         file_id = request.args.get('file_id', '').strip()
-        data = request.get_json()
         
         if not file_id:
             return jsonify({'error': 'Missing file_id parameter'}), 400
         
-        if not data:
-            return jsonify({'error': 'No data provided'}), 400
+        # A patch (unified diff or byte-range edits) carries only the change;
+        # anything else is the full new content, in the /api/upload formats
+        try:
+            fields, patch = read_patch_request()
+            if patch is None:
+                fields, blob = read_upload_request()
+        except UploadError as e:
+            return jsonify({'error': str(e)}), 400
         
-        filename = data.get('filename', '').strip()
-        content = data.get('content', '').strip()
-        password = data.get('password', '').strip()
+        filename = fields.get('filename', '').strip()
+        password = fields.get('password', '').strip()
+        base_hash = str(fields.get('base_hash') or '').strip()
         
-        if not filename or not content:
+        if patch is None and (not filename or blob is None):
             return jsonify({'error': 'Missing filename or content'}), 400
+        if patch is not None and not base_hash:
+            return jsonify({'error': 'base_hash is required for patch updates'}), 400
         
         # Check if file exists
-        files_data = load_data()
-        if file_id not in files_data:
+        file_info = get_file_info(file_id)
+        if file_info is None:
             return jsonify({'error': 'File not found'}), 404
         
-        file_info = files_data[file_id]
-        
         # Check password if private
         if file_info['is_private'] and file_info['has_password']:
-            passwords_data = load_passwords()
-            
-            if file_id not in passwords_data or \
-               passwords_data[file_id] != hash_password(password):
+            if get_password_hash(file_id) != hash_password(password):
                 return jsonify({'error': 'Invalid password'}), 403
         
-        # Sanitize filename
-        filename = sanitize_filename(filename)
-        
-        # Update the file
-        save_filename = f"{file_id}_{filename}"
-        file_path = os.path.join(UPLOAD_FOLDER, save_filename)
+        # Optimistic concurrency: the update must be based on the current content
+        if base_hash and base_hash != file_info.get('blob_hash'):
+            return version_conflict(file_info)
         
-        # Decode and save new file
-        try:
-            file_content = base64.b64decode(content)
-        except:
-            return jsonify({'error': 'Invalid file encoding'}), 400
+        old_content = new_content = None
+        if patch is not None:
+            with timed('patch'):
+                old_content = read_content(file_info)
+                try:
+                    new_content = apply_patch(old_content, patch)
+                except PatchError as e:
+                    return jsonify({'error': str(e)}), 400
+            if not new_content:
+                return jsonify({'error': 'The patch leaves the file empty'}), 400
+            with timed('write'):
+                blob = stage_blob(new_content)
         
-        # Remove old file if name changed
-        old_file_path = os.path.join(UPLOAD_FOLDER, file_info['saved_name'])
-        if os.path.exists(old_file_path) and old_file_path != file_path:
-            os.remove(old_file_path)
+        # Sanitize filename
+        filename = sanitize_filename(filename or file_info['original_name'])
         
-        with open(file_path, 'wb') as f:
-            f.write(file_content)
+        with timed('compile'):
+            syntax_error = precompile_blob(blob)
+        with timed('compress'):
+            compress_blob(blob)
         
-        # Update metadata
-        files_data[file_id] = {
+        # Update metadata; the previous content is kept as a delta (or a
+        # full copy) in the version history and its own reference released
+        old_blob_hash = file_info.get('blob_hash')
+        new_info = {
             'original_name': filename,
-            'saved_name': save_filename,
+            'blob_hash': blob.hash,
             'upload_time': datetime.now().isoformat(),
             'is_private': file_info['is_private'],
             'has_password': file_info['has_password'],
-            'size_bytes': len(file_content),
+            'size_bytes': blob.size_bytes,
             'updated': True
         }
+        if syntax_error:
+            new_info['syntax_error'] = syntax_error
+        if file_info.get('expires_at'):
+            new_info['expires_at'] = file_info['expires_at']
+        
+        for attempt in range(3):
+            with timed('delta'):
+                delta = version_delta(file_info, blob, old_content, new_content)
+            try:
+                with timed('db'):
+                    save_file_version(file_id, new_info, blob, file_info.get('blob_hash'), delta)
+                break
+            except VersionConflict as e:
+                # Without a base_hash the client asked for a plain overwrite, so
+                # redo the delta against whatever is current now
+                if base_hash or e.current_info is None or attempt == 2:
+                    if e.current_info is None:
+                        return jsonify({'error': 'File not found'}), 404
+                    return version_conflict(e.current_info)
+                file_info, old_content = e.current_info, None
+        if storage_sweeper.over_quota():
+            storage_sweeper.wake()
         
-        save_data(files_data)
+        if old_blob_hash and old_blob_hash != blob.hash:
+            execution_cache.invalidate(old_blob_hash)
         
         # Generate URLs
         base_url = request.host_url.rstrip('/')
@@ -571,35 +4289,138 @@ def update_file():
             'success': True,
             'message': 'File updated successfully',
             'file_id': file_id,
+            'version': new_info['version'],
+            'content_hash': blob.hash,
             'raw_url': f"{base_url}/api/raw?file_id={file_id}",
-            'execute_url': f"{base_url}/api/execute?file_id={file_id}"
+            'execute_url': f"{base_url}/api/execute?file_id={file_id}",
+            'versions_url': f"{base_url}/api/versions?file_id={file_id}"
         }
+        if syntax_error:
+            response['syntax_error'] = syntax_error
         
         return jsonify(response), 200
         
     except Exception as e:
         return jsonify({'error': f'Server error: {str(e)}'}), 500
+    finally:
+        if blob is not None:
+            blob.discard()
 
-@app.route('/api/status')
-def status():
+def version_conflict(current_info):
+    """409 for an update whose base_hash is not the current content's hash"""
+    return jsonify({
+        'error': 'base_hash does not match the current version',
+        'current_hash': current_info.get('blob_hash'),
+        'current_version': current_info.get('version', 1)
+    }), 409
+
+@app.route('/api/versions')
+def list_versions():
+    """Version history of a paste, newest first"""
     try:
-        files_data = load_data()
-        total_files = len(files_data)
+        file_id = request.args.get('file_id', '').strip()
+        if not file_id:
+            return jsonify({'error': 'Missing file_id parameter'}), 400
         
-        public_files = 0
-        private_files = 0
+        file_info = get_file_info(file_id)
+        if file_info is None:
+            return jsonify({'error': 'File not found'}), 404
+        if file_info['is_private'] and file_info['has_password']:
+            password = request.args.get('password', '').strip()
+            if not password or get_password_hash(file_id) != hash_password(password):
+                return jsonify({'error': 'Invalid password'}), 403
         
-        for file_info in files_data.values():
-            if file_info.get('is_private', False):
-                private_files += 1
-            else:
-                public_files += 1
+        current = {
+            'version': file_info.get('version', 1),
+            'content_hash': file_info.get('blob_hash'),
+            'size_bytes': file_info['size_bytes'],
+            'filename': file_info['original_name'],
+            'created_at': file_info['upload_time'],
+            'stored_as': 'current'
+        }
+        versions = [current] + load_versions(file_id)
+        
+        base_url = request.host_url.rstrip('/')
+        for entry in versions:
+            entry['raw_url'] = f"{base_url}/api/raw?file_id={file_id}&version={entry['version']}"
+            entry['execute_url'] = f"{base_url}/api/execute?file_id={file_id}&version={entry['version']}"
+        return jsonify({'file_id': file_id, 'current_version': current['version'], 'versions': versions}), 200
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/list')
+def list_files():
+    try:
+        sort = request.args.get('sort', 'upload_time')
+        order = request.args.get('order', 'desc')
+        prefix = request.args.get('prefix', '')
+        if sort not in LIST_SORT_COLUMNS:
+            return jsonify({'error': f"sort must be one of: {', '.join(LIST_SORT_COLUMNS)}"}), 400
+        if order not in ('asc', 'desc'):
+            return jsonify({'error': "order must be 'asc' or 'desc'"}), 400
+        try:
+            limit = int(request.args.get('limit', LIST_DEFAULT_LIMIT))
+        except ValueError:
+            return jsonify({'error': 'limit must be an integer'}), 400
+        limit = max(1, min(limit, LIST_MAX_LIMIT))
+        
+        # The cursor records the query it belongs to, so it can't be replayed
+        # against a different sort, order or prefix
+        after = None
+        cursor = request.args.get('cursor', '')
+        if cursor:
+            try:
+                state = json.loads(base64.urlsafe_b64decode(cursor.encode() + b'=' * (-len(cursor) % 4)))
+                if state['q'] != [sort, order, prefix]:
+                    raise ValueError
+                after = tuple(state['after'])
+            except Exception:
+                return jsonify({'error': 'Invalid cursor'}), 400
+        
+        with timed('lookup'):
+            try:
+                rows = list_public_files(sort, order == 'desc', prefix, limit, after)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            state = {'q': [sort, order, prefix], 'after': [last[sort], last['file_id']]}
+            next_cursor = base64.urlsafe_b64encode(json.dumps(state).encode()).decode().rstrip('=')
+        
+        base_url = request.host_url.rstrip('/')
+        files = [
+            dict(row,
+                 raw_url=f"{base_url}/api/raw?file_id={row['file_id']}",
+                 execute_url=f"{base_url}/api/execute?file_id={row['file_id']}")
+            for row in rows
+        ]
+        return jsonify({'files': files, 'next_cursor': next_cursor}), 200
+        
+    except Exception as e:
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+
+@app.route('/api/status')
+def status():
+    try:
+        counters = get_counters()
         
         status_data = {
             'status': 'online',
-            'total_files': total_files,
-            'public_files': public_files,
-            'private_files': private_files,
+            'total_files': counters['total_files'],
+            'public_files': counters['public_files'],
+            'private_files': counters['private_files'],
+            'bytes_stored': counters['bytes_stored'],
+            'metadata_cache': metadata_cache.stats(),
+            'execution_cache': execution_cache.stats(),
+            'group_commit': group_committer.stats(),
+            'sweeper': storage_sweeper.stats(),
+            'execution_limits': EXEC_LIMITS,
+            'rate_limits': rate_limiter.stats(),
+            'execution_backlog': execution_backlog.stats(),
             'timestamp': datetime.now().isoformat()
         }
         
@@ -608,6 +4429,73 @@ def status():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/execution-stats')
+def execution_stats_endpoint():
+    """Resource use per paste: ?file_id= for one paste, or (admin only) the most expensive ones"""
+    try:
+        file_id = request.args.get('file_id', '').strip()
+        if file_id:
+            file_info = get_file_info(file_id)
+            if file_info is None:
+                return jsonify({'error': 'File not found'}), 404
+            if file_info['is_private'] and file_info['has_password']:
+                password = request.args.get('password', '').strip()
+                if not password or get_password_hash(file_id) != hash_password(password):
+                    return jsonify({'error': 'Invalid password'}), 403
+            stats = load_execution_stats(file_id)
+            return jsonify(stats or {'file_id': file_id, 'filename': file_info['original_name'], 'runs': 0}), 200
+        
+        # Across pastes this names private ones too, so it is for operators only
+        if not ADMIN_TOKEN or not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+            return jsonify({'error': 'Listing execution stats requires a valid X-Admin-Token header'}), 403
+        
+        sort = request.args.get('sort', 'cpu_seconds')
+        if sort not in EXECUTION_STATS_SORT_COLUMNS:
+            return jsonify({'error': f"sort must be one of {', '.join(EXECUTION_STATS_SORT_COLUMNS)}"}), 400
+        try:
+            limit = int(request.args.get('limit', '50'))
+        except ValueError:
+            return jsonify({'error': 'limit must be a number'}), 400
+        limit = max(1, min(limit, 200))
+        
+        return jsonify({'sort': sort, 'files': load_execution_stats(sort=sort, limit=limit)}), 200
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/metrics')
+def metrics_endpoint():
+    try:
+        return metrics.render(storage_gauges()), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+    except Exception as e:
+        return f'Server error: {str(e)}', 500
+
+@app.route('/api/job')
+def job_status():
+    try:
+        job_id = request.args.get('job_id', '').strip()
+        
+        if not job_id:
+            return jsonify({'error': 'Missing job_id parameter'}), 400
+        
+        job = job_scheduler.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        
+        return jsonify(job), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/pool')
+def pool_status():
+    try:
+        if interpreter_pool is None:
+            return jsonify({'enabled': False, 'size': 0, 'scheduler': job_scheduler.stats()}), 200
+        return jsonify({**interpreter_pool.status(), 'scheduler': job_scheduler.stats()}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 # Error handlers
 @app.errorhandler(404)
 def not_found(error):
@@ -617,46 +4505,382 @@ def not_found(error):
 def server_error(error):
     return jsonify({'error': 'Internal server error'}), 500
 
-# Vercel serverless function handler
-def handler(request, context):
-    # Convert Vercel request to WSGI
-    environ = {
-        'REQUEST_METHOD': request.method,
-        'PATH_INFO': request.path,
-        'QUERY_STRING': request.query_string.decode() if request.query_string else '',
-        'SERVER_NAME': 'localhost',
-        'SERVER_PORT': '80',
-        'wsgi.url_scheme': 'http',
-        'wsgi.input': request.body,
-        'CONTENT_TYPE': request.headers.get('content-type', ''),
-        'CONTENT_LENGTH': str(len(request.body)) if request.body else '0',
-    }
+# On-demand profiling: ?profile=1 saves cProfile stats under PROFILE_DIR and
+# returns the normal response; ?profile=text returns the stats report instead.
+class RequestProfiler:
+    """WSGI middleware that profiles admin-authenticated requests only"""
+    
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+    
+    def __call__(self, environ, start_response):
+        mode = parse_qs(environ.get('QUERY_STRING', '')).get('profile', [''])[0]
+        if not mode or not ADMIN_TOKEN:
+            return self.wsgi_app(environ, start_response)
+        
+        if not hmac.compare_digest(environ.get('HTTP_X_ADMIN_TOKEN', ''), ADMIN_TOKEN):
+            start_response('403 FORBIDDEN', [('Content-Type', 'application/json')])
+            return [b'{"error": "Profiling requires a valid X-Admin-Token header"}']
+        
+        captured = {}
+        def capture(status, headers, exc_info=None):
+            captured['status'], captured['headers'] = status, headers
+            return lambda data: None
+        
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            # Consume the whole body so streamed work is profiled too
+            result = self.wsgi_app(environ, capture)
+            try:
+                body = b''.join(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        finally:
+            profiler.disable()
+        
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        route = environ.get('PATH_INFO', '/').strip('/').replace('/', '.') or 'root'
+        profile_path = os.path.join(PROFILE_DIR, f"{route}.{time.time_ns()}.prof")
+        profiler.dump_stats(profile_path)
+        
+        if mode == 'text':
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(50)
+            start_response('200 OK', [('Content-Type', 'text/plain; charset=utf-8'),
+                                      ('X-Profile-Path', profile_path)])
+            return [report.getvalue().encode('utf-8')]
+        
+        headers = [(k, v) for k, v in captured['headers'] if k.lower() != 'content-length']
+        headers += [('Content-Length', str(len(body))), ('X-Profile-Path', profile_path)]
+        start_response(captured['status'], headers)
+        return [body]
+
+app.wsgi_app = RequestProfiler(app.wsgi_app)
+
+# ASGI mode: serve asgi_app (e.g. `uvicorn api.index:asgi_app`) instead of
+# app. Requests still run through the Flask app, on a thread pool, except
+# that the execute route hands back an async body that runs on the event
+# loop, so waiting on a script costs no thread.
+ASGI_ENVIRON_KEY = 'pastebin.asgi'  # Per-request state shared by the bridge and async_response()
+
+def async_response(body, **kwargs):
+    """A response whose body is an async iterator of bytes, which only asgi_app can send
     
-    # Add headers
-    for key, value in request.headers.items():
-        environ[f'HTTP_{key.upper().replace("-", "_")}'] = value
+    A WSGI app can't return one, so the body is left in the request's ASGI
+    state and the bridge runs it once the app has returned.
+    """
+    request.environ[ASGI_ENVIRON_KEY]['body'] = body
+    return Response(iter(()), **kwargs)
+
+class _ReceiveStream(io.RawIOBase):
+    """wsgi.input read from ASGI receive() by a bridge thread"""
     
-    # WSGI response
-    response_headers = []
-    response_body = []
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.buffer = b''
+        self.offset = 0
+        self.more = True
     
-    def start_response(status, headers):
-        response_headers[:] = [status, headers]
-        return response_body.append
+    def readable(self):
+        return True
     
-    # Run Flask app
-    result = app(environ, start_response)
+    def readinto(self, b):
+        import asyncio
+        while self.offset >= len(self.buffer) and self.more:
+            message = asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result()
+            if message['type'] == 'http.disconnect':
+                self.more = False
+            else:
+                self.buffer, self.offset = message.get('body', b''), 0
+                self.more = message.get('more_body', False)
+        
+        n = min(len(b), len(self.buffer) - self.offset)
+        b[:n] = self.buffer[self.offset:self.offset + n]
+        self.offset += n
+        return n
+
+class ASGIBridge:
+    """Serves a WSGI app over ASGI, sending async_response() bodies from the event loop"""
     
-    # Build response
-    status_code = int(response_headers[0].split()[0])
-    headers = dict(response_headers[1])
+    def __init__(self, wsgi_app, threads):
+        self.wsgi_app = wsgi_app
+        self.threads = threads
+        self._executor = None
     
-    # Combine body chunks
-    body = b''.join([chunk if isinstance(chunk, bytes) else chunk.encode() 
-                    for chunk in response_body + list(result)])
+    @property
+    def executor(self):
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix='asgi')
+        return self._executor
     
-    return {
-        'statusCode': status_code,
-        'headers': headers,
-        'body': body.decode('utf-8') if isinstance(body, bytes) else body
-    }
+    def environ(self, scope, stream):
+        root_path = scope.get('root_path', '')
+        path = scope['path']
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            # WSGI strings carry the raw bytes as latin-1
+            'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+            'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': stream,
+            'wsgi.input_terminated': True,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            ASGI_ENVIRON_KEY: {},
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = f'HTTP_{name}'
+            environ[name] = f'{environ[name]},{value}' if name in environ else value
+        return environ
+    
+    def _start(self, environ):
+        """Run the app up to its first body chunk; returns (status, headers, result, iterator, first)"""
+        started = {}
+        
+        def start_response(status, headers, exc_info=None):
+            started['status'], started['headers'] = status, headers
+            return lambda data: None
+        
+        result = self.wsgi_app(environ, start_response)
+        iterator = iter(result)
+        first = next(iterator, b'')
+        return started['status'], started['headers'], result, iterator, first
+    
+    async def __call__(self, scope, receive, send):
+        import asyncio
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+        
+        loop = asyncio.get_running_loop()
+        environ = self.environ(scope, _ReceiveStream(receive, loop))
+        status, headers, result, iterator, first = await loop.run_in_executor(self.executor, self._start, environ)
+        body = environ[ASGI_ENVIRON_KEY].get('body')
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': int(status.split()[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+            })
+            if body is not None:
+                if not await self._send_async_body(body, receive, send):
+                    return
+            else:
+                chunk = first
+                while chunk is not None:
+                    if chunk:
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                    chunk = await loop.run_in_executor(self.executor, next, iterator, None)
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if body is not None:
+                await body.aclose()
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self.executor, result.close)
+    
+    async def _send_async_body(self, body, receive, send):
+        """Send body chunks until it ends (True) or the client disconnects (False)"""
+        import asyncio
+        
+        async def pump():
+            async for chunk in body:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        
+        async def disconnected():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+        
+        pumping = asyncio.ensure_future(pump())
+        watching = asyncio.ensure_future(disconnected())
+        try:
+            await asyncio.wait((pumping, watching), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            watching.cancel()
+            if not pumping.done():
+                # Cancelling the body kills the script it is waiting on
+                pumping.cancel()
+                try:
+                    await pumping
+                except asyncio.CancelledError:
+                    pass
+        return not pumping.cancelled() and pumping.result() is None
+
+asgi_app = ASGIBridge(app, ASGI_THREADS)
+
+# Vercel serverless function handler
+TEXT_MIMETYPES = ('application/json', 'application/javascript', 'application/xml', 'image/svg+xml')
+
+class VercelAdapter:
+    """Runs a WSGI app for the handler(request, context) event format
+    
+    The request body is handed to the app as a stream, and the response
+    iterable is consumed once, chunk by chunk, rather than listed, joined
+    and decoded. Text bodies go out as str, anything else (binary pastes,
+    gzip-encoded responses, archives, non-UTF-8 text) as base64 with
+    isBase64Encoded set.
+    """
+    
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+    
+    def environ(self, request):
+        from urllib.parse import unquote
+        # Header names arrive in whatever case the platform used
+        headers = {key.lower(): value for key, value in (request.headers or {}).items()}
+        path, _, query = (request.path or '/').partition('?')
+        query_string = request.query_string if getattr(request, 'query_string', None) is not None else query
+        if isinstance(query_string, bytes):
+            query_string = query_string.decode('latin-1')
+        
+        body = request.body
+        if body is None:
+            body = b''
+        elif isinstance(body, str):
+            body = body.encode('utf-8')
+        if hasattr(body, 'read'):
+            stream, length = body, headers.get('content-length', '')
+        else:
+            stream, length = io.BytesIO(body), str(len(body))
+        
+        host = headers.get('host', 'localhost')
+        forwarded = headers.get('x-forwarded-for', '')
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path, encoding='latin-1'),
+            'QUERY_STRING': query_string,
+            'SERVER_NAME': host.split(':')[0],
+            'SERVER_PORT': host.split(':')[1] if ':' in host else '443',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            # The platform adds the client address last; anything before it is client-sent
+            'REMOTE_ADDR': forwarded.split(',')[-1].strip() or '127.0.0.1',
+            'CONTENT_TYPE': headers.get('content-type', ''),
+            'CONTENT_LENGTH': length,
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': headers.get('x-forwarded-proto', 'https'),
+            'wsgi.input': stream,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for key, value in headers.items():
+            key = key.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[f'HTTP_{key}'] = value
+        return environ
+    
+    def stream(self, request):
+        """Run the app; returns (status_code, [(name, value)], body_chunks) without buffering
+        
+        For callers that can write the body as it is produced. The chunks
+        iterator closes the app's response when it is exhausted or closed.
+        """
+        started = {}
+        
+        def start_response(status, headers, exc_info=None):
+            if exc_info and started:
+                raise exc_info[1].with_traceback(exc_info[2])
+            started['status'], started['headers'] = status, headers
+            # The deprecated write() callable; nothing in this app uses it
+            return lambda data: started.setdefault('written', []).append(data)
+        
+        result = self.wsgi_app(self.environ(request), start_response)
+        iterator = iter(result)
+        # Headers are only final once the app has produced its first chunk
+        try:
+            first = next(iterator)
+        except StopIteration:
+            first = None
+        except BaseException:
+            if hasattr(result, 'close'):
+                result.close()
+            raise
+        
+        def chunks():
+            try:
+                yield from started.pop('written', ())
+                if first is not None:
+                    yield first
+                    yield from iterator
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        
+        return int(started['status'].split()[0]), started['headers'], chunks()
+    
+    def __call__(self, request, context=None):
+        status_code, headers, chunks = self.stream(request)
+        
+        # The event format needs the body as one value. A single-chunk
+        # response (the common case) is used as is; streamed ones are
+        # appended to one buffer as they arrive, so each chunk can be freed
+        body = b''
+        for chunk in chunks:
+            if not body:
+                body = chunk
+            elif chunk:
+                if isinstance(body, bytes):
+                    body = bytearray(body)
+                body += chunk
+        
+        single, multi = {}, {}
+        for name, value in headers:
+            if name in single:
+                multi.setdefault(name, [single[name]]).append(value)
+            single[name] = value
+        
+        event = {'statusCode': status_code, 'headers': single}
+        if multi:
+            event['multiValueHeaders'] = multi
+        
+        lowered = {name.lower(): value for name, value in headers}
+        content_type = lowered.get('content-type', '').split(';')[0].strip().lower()
+        is_text = ((content_type.startswith('text/') or content_type in TEXT_MIMETYPES)
+                   and 'content-encoding' not in lowered)
+        if is_text:
+            try:
+                event['body'] = body.decode('utf-8')
+                event['isBase64Encoded'] = False
+                return event
+            except UnicodeDecodeError:
+                pass
+        encoded = base64.b64encode(body)
+        del body
+        event['body'] = encoded.decode('ascii')
+        event['isBase64Encoded'] = True
+        return event
+
+vercel_adapter = VercelAdapter(app)
+
+def handler(request, context):
+    return vercel_adapter(request, context)
@@ -0,0 +1,367 @@
+"""Benchmarks for the upload, raw, execute, status and list paths
+
+Runs against the Flask app in-process (test client, throwaway data dir) or
+against a running server with --url. Each scenario reports throughput and
+p50/p95/p99 latency; results can be saved as a baseline and compared later.
+
+    python benchmarks/bench.py                          # everything, in-process
+    python benchmarks/bench.py --only upload raw        # selected scenarios
+    python benchmarks/bench.py --url http://localhost:3000 --concurrency 8
+    python benchmarks/bench.py --save-baseline bench_baseline.json
+    python benchmarks/bench.py --compare bench_baseline.json --threshold 0.15
+
+A server started for --url must run with RATE_LIMITING=0: the per-client
+limits would otherwise turn most of the requests into 429s, and the run stops
+at the first one rather than report their latency.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = ('upload', 'raw', 'execute', 'status', 'list')
+UPLOAD_SIZES = (1024, 16 * 1024, 256 * 1024, 1024 * 1024)
+RAW_HIT_RATES = (1.0, 0.5)
+STATUS_STORE_SIZES = (10_000, 100_000)
+
+TRIVIAL_SCRIPT = b'print("hello")\n'
+CPU_SCRIPT = b'total = 0\nfor i in range(2_000_000):\n    total += i * i\nprint(total)\n'
+
+
+# Targets
+class InProcessTarget:
+    """Drives the app through Flask's test client with its own data directory"""
+
+    name = 'in-process'
+
+    def __init__(self):
+        self.data_dir = tempfile.mkdtemp(prefix='pastebin-bench-')
+        os.environ['PASTEBIN_DATA_DIR'] = self.data_dir
+        os.environ.setdefault('REQUEST_LOG', '0')
+        os.environ.setdefault('RATE_LIMITING', '0')  # The benchmark is one client by design
+        sys.path.insert(0, REPO_ROOT)
+        from api import index
+        self.index = index
+        self.client = index.app.test_client()
+
+    def request(self, method, path, body=None, headers=None):
+        response = self.client.open(path, method=method, data=body, headers=headers or {})
+        return response.status_code, response.get_data()
+
+    def drop_caches(self):
+        self.index.metadata_cache.clear()
+
+    def seed(self, count):
+        """Grow the store to count pastes with direct batched inserts"""
+        index = self.index
+        existing = index.get_counters()['total_files']
+        if existing >= count:
+            return
+
+        def write(conn):
+            deltas = dict.fromkeys(index.COUNTER_NAMES, 0)
+            rows = []
+            for i in range(existing, count):
+                info = {
+                    'original_name': f'seed_{i}.py',
+                    'blob_hash': None,
+                    'upload_time': f'2024-01-01T00:00:{i % 60:02d}.{i:06d}',
+                    'is_private': i % 5 == 0,
+                    'has_password': False,
+                    'size_bytes': 100 + i % 1000
+                }
+                rows.append(index._file_row(f'seed{i:07d}', info))
+                for name, delta in index._file_counter_deltas(info, 1).items():
+                    deltas[name] += delta
+            conn.executemany(f'INSERT OR IGNORE INTO files {index.FILE_ROW_SQL}', rows)
+            index._bump_counters(conn, deltas)
+
+        index.write_transaction(write)
+
+
+class RateLimited(Exception):
+    pass
+
+
+class HttpTarget:
+    """Drives a running server over HTTP; a 429 raises RateLimited"""
+
+    name = 'http'
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def request(self, method, path, body=None, headers=None):
+        req = urllib.request.Request(self.base_url + path, data=body, method=method, headers=headers or {})
+        try:
+            with urllib.request.urlopen(req, timeout=60) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 429:
+                raise RateLimited(f'{method} {path} was rate limited; start the server with RATE_LIMITING=0')
+            return e.code, e.read()
+
+    def seed(self, count):
+        # Seeding over HTTP would take far longer than the measurement itself
+        pass
+
+    def drop_caches(self):
+        # Not reachable from here; walking pages by cursor mostly misses anyway
+        pass
+
+
+# Measurement
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(name, make_request, iterations, concurrency, warmup=3):
+    """Call make_request() iterations times; returns a result dict"""
+    for _ in range(warmup):
+        make_request()
+
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one(_):
+        nonlocal errors
+        started = time.perf_counter()
+        ok = make_request()
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if not ok:
+                errors += 1
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as pool:
+            list(pool.map(one, range(iterations)))
+    else:
+        for i in range(iterations):
+            one(i)
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'name': name,
+        'requests': iterations,
+        'errors': errors,
+        'throughput_rps': round(iterations / wall, 2) if wall else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def upload(target, content, filename='bench.py'):
+    status, body = target.request(
+        'POST', f'/api/upload?filename={filename}', body=content,
+        headers={'Content-Type': 'application/octet-stream'}
+    )
+    if status != 200:
+        raise RuntimeError(f'Upload failed ({status}): {body[:200]!r}')
+    return json.loads(body)['file_id']
+
+
+# Scenarios
+def bench_upload(target, args):
+    results = []
+    for size in UPLOAD_SIZES:
+        def make_request(size=size):
+            # Unique content each time so dedup doesn't skip the write
+            content = b'# %d\n' % random.getrandbits(64) + b'x = 1\n' * (size // 6)
+            status, _ = target.request('POST', '/api/upload?filename=bench.py', body=content,
+                                       headers={'Content-Type': 'application/octet-stream'})
+            return status == 200
+        results.append(measure(f'upload/{size // 1024}KiB', make_request, args.iterations, args.concurrency))
+    return results
+
+
+def bench_raw(target, args):
+    file_ids = [upload(target, b'print(%d)\n' % i * 200) for i in range(20)]
+    results = []
+    for hit_rate in RAW_HIT_RATES:
+        def make_request(hit_rate=hit_rate):
+            if random.random() < hit_rate:
+                file_id, expected = random.choice(file_ids), 200
+            else:
+                file_id, expected = 'missing0', 404
+            status, _ = target.request('GET', f'/api/raw?file_id={file_id}')
+            return status == expected
+        results.append(measure(f'raw/hit{int(hit_rate * 100)}', make_request, args.iterations, args.concurrency))
+    return results
+
+
+def bench_execute(target, args):
+    results = []
+    for name, script, iterations in (('trivial', TRIVIAL_SCRIPT, args.iterations),
+                                     ('cpu', CPU_SCRIPT, max(args.iterations // 10, 5))):
+        file_id = upload(target, script)
+
+        def make_request(file_id=file_id):
+            status, body = target.request('GET', f'/api/execute?file_id={file_id}')
+            return status == 200 and b'Status: Success' in body
+        results.append(measure(f'execute/{name}', make_request, iterations, args.concurrency))
+    return results
+
+
+def bench_status(target, args):
+    results = []
+    sizes = STATUS_STORE_SIZES if target.name == 'in-process' else (None,)
+    for size in sizes:
+        if size:
+            target.seed(size)
+
+        def make_request():
+            status, _ = target.request('GET', '/api/status')
+            return status == 200
+        label = f'status/{size // 1000}k' if size else 'status/current'
+        results.append(measure(label, make_request, args.iterations, args.concurrency))
+    return results
+
+
+def bench_list(target, args):
+    results = []
+    sizes = STATUS_STORE_SIZES if target.name == 'in-process' else (None,)
+    for size in sizes:
+        if size:
+            target.seed(size)
+        label = f'{size // 1000}k' if size else 'current'
+
+        # A cursor a few pages in, so deep pages are measured too
+        status, body = target.request('GET', '/api/list?sort=size_bytes&limit=50')
+        cursor = json.loads(body).get('next_cursor') if status == 200 else None
+
+        for name, path in (('first', '/api/list?limit=50'),
+                           ('cursor', f'/api/list?sort=size_bytes&limit=50&cursor={cursor}'),
+                           ('prefix', '/api/list?prefix=seed_99&limit=50')):
+            if name == 'cursor' and not cursor:
+                continue
+
+            def make_request(path=path):
+                status, _ = target.request('GET', path)
+                return status == 200
+            results.append(measure(f'list/{name}/{label}', make_request, args.iterations, args.concurrency))
+
+        # Paging through a prefix search with a cold cache, one page per request,
+        # so each lookup is a real query from an arbitrary cursor
+        for short, sort in (('time', 'upload_time'), ('size', 'size_bytes'), ('name', 'filename')):
+            results.append(measure(f'list/walk-{short}/{label}', prefix_walker(target, sort),
+                                   args.iterations, args.concurrency))
+    return results
+
+
+def prefix_walker(target, sort):
+    """make_request for bench_list: fetch the next page of a prefix listing, uncached"""
+    cursor = None
+
+    def make_request():
+        nonlocal cursor
+        target.drop_caches()
+        path = f'/api/list?prefix=seed_99&sort={sort}&limit=50'
+        status, body = target.request('GET', path + (f'&cursor={cursor}' if cursor else ''))
+        cursor = json.loads(body).get('next_cursor') if status == 200 else None
+        return status == 200
+    return make_request
+
+
+BENCHMARKS = {
+    'upload': bench_upload,
+    'raw': bench_raw,
+    'execute': bench_execute,
+    'status': bench_status,
+    'list': bench_list,
+}
+
+
+# Reporting
+def print_results(results):
+    print(f"{'scenario':<22} {'req':>6} {'err':>4} {'req/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for r in results:
+        print(f"{r['name']:<22} {r['requests']:>6} {r['errors']:>4} {r['throughput_rps']:>10.1f} "
+              f"{r['p50_ms']:>9.2f} {r['p95_ms']:>9.2f} {r['p99_ms']:>9.2f}")
+
+
+def compare(results, baseline, threshold):
+    """Print per-scenario changes against a baseline; returns names that regressed"""
+    previous = {r['name']: r for r in baseline['results']}
+    regressions = []
+    print(f"\n{'scenario':<22} {'req/s':>16} {'p95 ms':>16}")
+    for r in results:
+        old = previous.get(r['name'])
+        if old is None:
+            print(f"{r['name']:<22} {'(new)':>16}")
+            continue
+        rps_change = (r['throughput_rps'] - old['throughput_rps']) / old['throughput_rps'] if old['throughput_rps'] else 0.0
+        p95_change = (r['p95_ms'] - old['p95_ms']) / old['p95_ms'] if old['p95_ms'] else 0.0
+        regressed = rps_change < -threshold or p95_change > threshold
+        if regressed:
+            regressions.append(r['name'])
+        print(f"{r['name']:<22} {rps_change:>+15.1%} {p95_change:>+15.1%}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', help='Benchmark a running server instead of the in-process app')
+    parser.add_argument('--only', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--json', help='Write results to this file')
+    parser.add_argument('--save-baseline', help='Write results as a baseline file')
+    parser.add_argument('--compare', help='Compare against a baseline file')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='Relative throughput drop / p95 increase counted as a regression')
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    target = HttpTarget(args.url) if args.url else InProcessTarget()
+
+    results = []
+    try:
+        for scenario in args.only:
+            results.extend(BENCHMARKS[scenario](target, args))
+    except RateLimited as e:
+        print(f'Aborted: {e}', file=sys.stderr)
+        return 2
+    print_results(results)
+
+    report = {
+        'target': args.url or target.name,
+        'python': sys.version.split()[0],
+        'iterations': args.iterations,
+        'concurrency': args.concurrency,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"\nRegressed: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,181 @@
+"""Cold-start measurements for the function entry point
+
+Each run starts a fresh interpreter with an empty data directory, imports
+api/index.py and sends a first request to a few routes, the way a new
+serverless instance would. Reports import time and first-request latency
+(median and worst over --runs), and optionally the slowest imports.
+
+    python benchmarks/cold_start.py
+    python benchmarks/cold_start.py --runs 20 --json cold_start.json
+    python benchmarks/cold_start.py --max-import-ms 400 --max-first-request-ms 50   # exit 1 if slower
+    python benchmarks/cold_start.py --importtime 15
+
+Every run also sends an upload and each kind of batch upload as the very
+first request of a fresh process, and fails if any of them is not a 200.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in the fresh interpreter; prints one JSON line of timings in milliseconds
+CHILD_SOURCE = r'''
+import json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+from api import index
+imported = time.perf_counter()
+
+client = index.app.test_client()
+timings = {'import': (imported - started) * 1000}
+for name, method, path, kwargs in (
+    ('home', 'GET', '/', {}),
+    ('status', 'GET', '/api/status', {}),
+    ('upload', 'POST', '/api/upload?filename=cold.py',
+     {'data': b'print(1)\n', 'headers': {'Content-Type': 'application/octet-stream'}}),
+):
+    request_started = time.perf_counter()
+    response = client.open(path, method=method, **kwargs)
+    timings[name] = (time.perf_counter() - request_started) * 1000
+    if response.status_code != 200:
+        raise SystemExit(f'{method} {path} returned {response.status_code}')
+print(json.dumps(timings))
+'''
+
+PHASES = ('import', 'home', 'status', 'upload')
+
+# Runs one request as the very first one a fresh process serves, so nothing
+# else has set up storage before it; prints its status code
+FIRST_REQUEST_SOURCE = r'''
+import io, sys, tarfile, zipfile
+sys.path.insert(0, sys.argv[1])
+from api import index
+
+def archive(kind):
+    buffer = io.BytesIO()
+    if kind == 'zip':
+        with zipfile.ZipFile(buffer, 'w') as archive:
+            archive.writestr('a.py', 'print(1)\n')
+    else:
+        with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+            member = tarfile.TarInfo('a.py')
+            member.size = 9
+            archive.addfile(member, io.BytesIO(b'print(1)\n'))
+    return buffer.getvalue()
+
+case = sys.argv[2]
+client = index.app.test_client()
+if case == 'upload':
+    response = client.post('/api/upload?filename=cold.py', data=b'print(1)\n',
+                           headers={'Content-Type': 'application/octet-stream'})
+elif case == 'batch-json':
+    response = client.post('/api/upload/batch', json={'files': [{'filename': 'a.py', 'content': 'cHJpbnQoMSkK'}]})
+else:
+    content_type = 'application/zip' if case == 'batch-zip' else 'application/gzip'
+    response = client.post('/api/upload/batch', data=archive(case[len('batch-'):]),
+                           headers={'Content-Type': content_type})
+print(response.status_code)
+'''
+
+FIRST_REQUEST_CASES = ('upload', 'batch-json', 'batch-zip', 'batch-tar')
+
+
+def child_env(data_dir):
+    env = dict(os.environ)
+    env['PASTEBIN_DATA_DIR'] = data_dir
+    env['REQUEST_LOG'] = '0'
+    return env
+
+
+def run_once():
+    with tempfile.TemporaryDirectory(prefix='pastebin-cold-') as data_dir:
+        result = subprocess.run(
+            [sys.executable, '-c', CHILD_SOURCE, REPO_ROOT],
+            capture_output=True, text=True, env=child_env(data_dir), timeout=120
+        )
+    if result.returncode != 0:
+        raise RuntimeError(f'Cold start run failed:\n{result.stderr}')
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def check_first_requests():
+    """Run each FIRST_REQUEST_CASES request in a fresh process; returns the failures"""
+    failures = []
+    for case in FIRST_REQUEST_CASES:
+        with tempfile.TemporaryDirectory(prefix='pastebin-cold-') as data_dir:
+            result = subprocess.run(
+                [sys.executable, '-c', FIRST_REQUEST_SOURCE, REPO_ROOT, case],
+                capture_output=True, text=True, env=child_env(data_dir), timeout=120
+            )
+        output = result.stdout.strip().splitlines()
+        status = output[-1] if output else (result.stderr.strip().splitlines() or ['no output'])[-1]
+        if result.returncode != 0 or status != '200':
+            failures.append(f'first request {case} returned {status}')
+    return failures
+
+def slowest_imports(count):
+    """Cumulative -X importtime entries for api.index, slowest first"""
+    with tempfile.TemporaryDirectory(prefix='pastebin-cold-') as data_dir:
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import sys; sys.path.insert(0, {REPO_ROOT!r}); import api.index'],
+            capture_output=True, text=True, env=child_env(data_dir), timeout=120
+        )
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        # import time: <self us> | <cumulative us> | <module>
+        self_part, cumulative_us, name = line.split('|')
+        entries.append((int(cumulative_us), int(self_part.split(':')[1]), name.rstrip()))
+    entries.sort(reverse=True)
+    return entries[:count]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--json', help='Write results to this file')
+    parser.add_argument('--max-import-ms', type=float, help='Fail if the median import time is above this')
+    parser.add_argument('--max-first-request-ms', type=float,
+                        help='Fail if any median first-request latency is above this')
+    parser.add_argument('--importtime', type=int, metavar='N', help='Also list the N slowest imports')
+    args = parser.parse_args(argv)
+
+    runs = [run_once() for _ in range(args.runs)]
+    summary = {}
+    print(f"{'phase':<10} {'median ms':>10} {'max ms':>10}")
+    for phase in PHASES:
+        values = [run[phase] for run in runs]
+        summary[phase] = {'median_ms': round(statistics.median(values), 2), 'max_ms': round(max(values), 2)}
+        print(f"{phase:<10} {summary[phase]['median_ms']:>10.2f} {summary[phase]['max_ms']:>10.2f}")
+
+    if args.importtime:
+        print(f"\n{'cumulative ms':>14} {'self ms':>8}  module")
+        for cumulative_us, self_us, name in slowest_imports(args.importtime):
+            print(f'{cumulative_us / 1000:>14.2f} {self_us / 1000:>8.2f}  {name}')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'runs': args.runs, 'phases': summary}, f, indent=2)
+
+    # Correctness rather than speed: each of these must work as a process's first request
+    failures = check_first_requests()
+    if args.max_import_ms is not None and summary['import']['median_ms'] > args.max_import_ms:
+        failures.append(f"import {summary['import']['median_ms']} ms > {args.max_import_ms} ms")
+    if args.max_first_request_ms is not None:
+        for phase in PHASES[1:]:
+            if summary[phase]['median_ms'] > args.max_first_request_ms:
+                failures.append(f"{phase} {summary[phase]['median_ms']} ms > {args.max_first_request_ms} ms")
+    if failures:
+        print('\nFailed: ' + '; '.join(failures))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,202 @@
+"""Local stand-in for the Vercel handler(request, context) event format
+
+Builds request objects shaped like the ones the platform passes to
+api/index.py's handler(), runs them through it and decodes the returned
+{statusCode, headers, body, isBase64Encoded} event the way the platform
+would. By default it runs a set of round-trip checks (text, binary,
+non-UTF-8 and gzip-encoded bodies, large uploads, streamed archives) in a
+throwaway data dir; --serve exposes the handler over real HTTP instead.
+
+    python scripts/vercel_harness.py
+    python scripts/vercel_harness.py --serve 3000            # buffered, like the platform
+    python scripts/vercel_harness.py --serve 3000 --stream   # writes chunks as they come
+"""
+import argparse
+import base64
+import gzip
+import io
+import json
+import os
+import sys
+import tarfile
+import tempfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class VercelRequest:
+    """The attributes handler() reads from the platform's request object"""
+
+    def __init__(self, method, url, headers=None, body=b''):
+        parts = urlsplit(url)
+        self.method = method
+        self.path = parts.path or '/'
+        self.query_string = parts.query.encode('latin-1')
+        # The platform lower-cases header names
+        self.headers = {key.lower(): value for key, value in (headers or {}).items()}
+        self.body = body
+
+
+def load_index(data_dir=None):
+    os.environ['PASTEBIN_DATA_DIR'] = data_dir or tempfile.mkdtemp(prefix='pastebin-vercel-')
+    os.environ.setdefault('REQUEST_LOG', '0')
+    sys.path.insert(0, REPO_ROOT)
+    from api import index
+    return index
+
+
+def call(index, method, url, headers=None, body=b''):
+    """Run one request through handler(); returns (status, headers, body bytes)"""
+    event = index.handler(VercelRequest(method, url, headers, body), None)
+    assert isinstance(event['body'], str), 'event body must be a str'
+    if event['isBase64Encoded']:
+        body = base64.b64decode(event['body'])
+    else:
+        body = event['body'].encode('utf-8')
+    return event['statusCode'], event['headers'], body, event
+
+
+# Checks
+def check_text(index):
+    status, headers, body, event = call(index, 'GET', '/api/status')
+    assert status == 200 and not event['isBase64Encoded']
+    assert 'total_files' in json.loads(body)
+
+
+def check_gzip_page(index):
+    status, headers, body, event = call(index, 'GET', '/', {'Accept-Encoding': 'gzip'})
+    assert status == 200 and headers.get('Content-Encoding') == 'gzip'
+    assert event['isBase64Encoded'], 'gzip bodies are binary even when the type is text/html'
+    assert b'Python Pastebin' in gzip.decompress(body)
+
+
+def upload(index, content, filename='harness.py', query=''):
+    status, _, body, _ = call(index, 'POST', f'/api/upload?filename={filename}{query}',
+                              {'Content-Type': 'application/octet-stream'}, content)
+    assert status == 200, body
+    return json.loads(body)['file_id']
+
+
+def check_non_utf8(index):
+    content = b'# \xff\xfe latin-1: \xe9\nprint(1)\n'
+    file_id = upload(index, content)
+    status, _, body, event = call(index, 'GET', f'/api/raw?file_id={file_id}')
+    assert status == 200 and event['isBase64Encoded'], 'non-UTF-8 text must fall back to base64'
+    assert body == content
+
+
+def check_large_roundtrip(index):
+    content = b''.join(b'x_%d = %d\n' % (i, i) for i in range(400_000))  # ~5 MiB
+    file_id = upload(index, content, 'large.py')
+    status, _, body, _ = call(index, 'GET', f'/api/raw?file_id={file_id}')
+    assert status == 200 and body == content
+    status, headers, body, _ = call(index, 'GET', f'/api/raw?file_id={file_id}', {'Accept-Encoding': 'gzip'})
+    assert status == 200 and headers.get('Content-Encoding') == 'gzip'
+    assert gzip.decompress(body) == content
+
+
+def check_streamed_archive(index):
+    ids = [upload(index, b'print(%d)\n' % i, f'part{i}.py') for i in range(3)]
+    status, _, body, event = call(index, 'GET', f"/api/download/batch?file_ids={','.join(ids)}&format=tar")
+    assert status == 200 and event['isBase64Encoded']
+    with tarfile.open(fileobj=io.BytesIO(body)) as archive:
+        assert len(archive.getnames()) == 3
+
+
+def check_stream_api(index):
+    file_id = upload(index, b'print("streamed")\n')
+    status, headers, chunks = index.vercel_adapter.stream(
+        VercelRequest('GET', f'/api/execute?file_id={file_id}&stream=1'))
+    body = b''.join(chunks)
+    assert status == 200 and b'streamed' in body
+
+
+def check_not_found(index):
+    status, _, body, event = call(index, 'GET', '/api/no-such-route')
+    assert status == 404 and not event['isBase64Encoded']
+    assert json.loads(body)['error']
+    status, _, body, event = call(index, 'GET', '/api/raw?file_id=missing0')
+    assert status == 404 and body == b'File not found'
+
+
+CHECKS = [check_text, check_gzip_page, check_non_utf8, check_large_roundtrip,
+          check_streamed_archive, check_stream_api, check_not_found]
+
+
+def run_checks(index):
+    failures = 0
+    for check in CHECKS:
+        try:
+            check(index)
+            print(f'ok    {check.__name__}')
+        except Exception as e:
+            failures += 1
+            print(f'FAIL  {check.__name__}: {e!r}')
+    return 1 if failures else 0
+
+
+# Local server
+def serve(index, port, stream):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def handle_one(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            # Headers the platform's proxy adds in front of the function
+            headers = dict(self.headers.items(), **{'x-forwarded-proto': 'http',
+                                                    'x-forwarded-for': self.client_address[0]})
+            request = VercelRequest(self.command, self.path, headers, self.rfile.read(length))
+            if stream:
+                status, headers, chunks = index.vercel_adapter.stream(request)
+                self.send_response(status)
+                for name, value in headers:
+                    self.send_header(name, value)
+                if not any(name.lower() == 'content-length' for name, _ in headers):
+                    self.send_header('Connection', 'close')
+                    self.close_connection = True
+                self.end_headers()
+                for chunk in chunks:
+                    self.wfile.write(chunk)
+                return
+
+            event = index.handler(request, None)
+            body = event['body']
+            body = base64.b64decode(body) if event['isBase64Encoded'] else body.encode('utf-8')
+            self.send_response(event['statusCode'])
+            multi = event.get('multiValueHeaders', {})
+            for name, value in event['headers'].items():
+                for item in multi.get(name, [value]):
+                    if name.lower() not in ('content-length', 'transfer-encoding'):
+                        self.send_header(name, item)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = handle_one
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    print(f"Serving handler() on http://127.0.0.1:{port} ({'streaming' if stream else 'buffered'})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--serve', type=int, metavar='PORT', help='Serve the handler over HTTP instead')
+    parser.add_argument('--stream', action='store_true', help='With --serve, write response chunks as produced')
+    parser.add_argument('--data-dir', help='Data directory (default: a new temporary one)')
+    args = parser.parse_args(argv)
+
+    index = load_index(args.data_dir)
+    if args.serve:
+        serve(index, args.serve, args.stream)
+        return 0
+    return run_checks(index)
+
+
+if __name__ == '__main__':
+    sys.exit(main())